@@ -1,7 +1,10 @@
-from ayayaxyz.bot import main
 from dotenv import load_dotenv
 
+# ayayaxyz.bot reads its settings from the environment when imported.
+load_dotenv()
+
+from ayayaxyz.bot import main  # noqa: E402
+
 
 if __name__ == "__main__":
-    load_dotenv()
     main()
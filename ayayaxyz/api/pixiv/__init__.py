@@ -1,27 +1,62 @@
 import asyncio
+import json
 import logging
+import multiprocessing
 import sys
 import time
-import requests_cache
+from concurrent.futures import Future, ProcessPoolExecutor
 from zipfile import ZipFile
 from io import BytesIO
 from pathlib import Path, PurePath
 from random import randint
-from threading import Thread
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from threading import Lock, Thread
+from typing import Any, Coroutine, Mapping
 from urllib.parse import urlparse
 
+from aiohttp import web
 from appdirs import user_cache_dir
-from flask import send_file, Flask, request
+from flask import send_file, Flask, Response, request
 from pixivpy3 import *
 
+from .cache import DiskCache, MemoryCache
+from .downloader import DOWNLOAD_BYTES, Downloader
+from .resize import UNREADABLE, fit_photo, fits
+from .tags import TagStore
+from .ugoira import PROFILES, EncoderProfile
+from .ugoira import encode_zip as encode_ugoira_zip
+from .ugoira import output_args as ugoira_output_args
 from .exceptions import *
+from .jobs import Job, JobQueue
+from .matcher import TagMatcher
+from .pool import SearchPool
+from .ratelimit import RateLimiter
+from ...metrics import STAGE_SECONDS
 
 
 class Pixiv:
-    def __init__(self):
+    # Cached images are immutable: their URL path includes the upload date.
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+    def __init__(
+        self,
+        cache_max_size: int | None = None,
+        stream_through: bool = False,
+        download_limit_per_host: int = 8,
+        illust_cache_size: int = 32 * 1024 * 1024,
+        illust_cache_ttl: float = 3600,
+        search_pool_ttl: float = 1800,
+        ugoira_pipe: bool = True,
+        ugoira_memory_limit: int = 16 * 1024 * 1024,
+        ugoira_workers: int = 2,
+        ugoira_profile: str = "webm",
+        resize_workers: int = 2,
+        app_api_rate: float = 4,
+        ajax_rate: float = 8,
+        image_rate: float = 32,
+    ):
         self._pixiv = ByPassSniApi()
         # self._pixiv.require_appapi_hosts()
-        self._session = requests_cache.CachedSession("ayayaxyz-api-pixiv")
         self._path = Path("./pixiv-cache")
         self._logger = logging.getLogger("ayayaxyz.api.pixiv")
         if not self._path.is_dir():
@@ -31,12 +66,63 @@ class Pixiv:
             self._path.mkdir(parents=True, exist_ok=True)
         self._ugoira_cache = self._path.joinpath("ugoira-cache")
         self._ugoira_cache.mkdir(exist_ok=True)
+        self._ugoira_meta = self._ugoira_cache.joinpath("meta")
+        self._ugoira_meta.mkdir(exist_ok=True)
+        # Pipe ugoira frames from the ZIP into ffmpeg instead of extracting them,
+        # ZIPs bigger than the memory limit are spooled to a temporary file.
+        self._ugoira_pipe = ugoira_pipe
+        self._ugoira_memory_limit = ugoira_memory_limit
+        self._ugoira_profile = ugoira_profile
+        # Jobs are keyed by (illust ID, encoder profile)
+        self._ugoira_jobs = JobQueue(
+            lambda key: self.get_video_from_ugoira(key[0], profile=key[1]),
+            max_workers=ugoira_workers,
+        )
         self._logger.info("Pixiv API cache path: {}".format(self._path))
+        self._cache = DiskCache(
+            self._path, max_size=cache_max_size, exclude={"ugoira-cache"}
+        )
+        # In-flight downloads, keyed by ("file" | "bytes", url)
+        self._inflight: dict[tuple[str, str], Future] = {}
+        self._inflight_lock = Lock()
+        # Relay images to the client while they're being downloaded to the cache
+        self._stream_through = stream_through
+        # Requests per second to each kind of Pixiv host, lowered on 429/403
+        self._limiter = RateLimiter(
+            app_rate=app_api_rate, ajax_rate=ajax_rate, image_rate=image_rate
+        )
+        self._downloader = Downloader(
+            limit_per_host=download_limit_per_host, limiter=self._limiter
+        )
+        # Downscaling originals too big for Telegram is CPU bound, the workers
+        # are spawned since we have threads running.
+        self._resize_pool = ProcessPoolExecutor(
+            max_workers=resize_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._tags = TagStore(self._path.joinpath("tags.sqlite"))
+        # Illust metadata, keyed by illust ID
+        self._illusts = MemoryCache(max_bytes=illust_cache_size, ttl=illust_cache_ttl)
+        # Search result pools, bounded by count rather than size
+        self._search_pools = MemoryCache(
+            max_bytes=256, ttl=search_pool_ttl, sizeof=lambda _: 1
+        )
         # Tag translation
         self._pixiv.set_accept_language("en-us")
         # Login workaround
         self._login_thread = None
 
+    async def _app_call(self, method, *args, **kwargs) -> Any:
+        """Calls an App API method in a thread, within the rate limit"""
+        await self._limiter.app.acquire()
+        result = await asyncio.to_thread(method, *args, **kwargs)
+        # pixivpy returns the error body instead of the status code.
+        error = result.get("error") if isinstance(result, dict) else None
+        if error and "rate limit" in str(error).lower():
+            self._limiter.app.throttled()
+        else:
+            self._limiter.app.success()
+        return result
+
     def login_token(self, refresh_token: str):
         if self._login_thread:
             return
@@ -68,81 +154,324 @@ class Pixiv:
             raise LoginError(e)
         self.login_token(refresh_token=login_rsp.get("refresh_token"))
 
+    def _claim_inflight(self, key: tuple[str, str]) -> tuple[Future, bool]:
+        """Returns the in-flight future for `key` and whether we now own it"""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._inflight[key] = future
+            return future, True
+
+    def _release_inflight(
+        self,
+        key: tuple[str, str],
+        future: Future,
+        result: Any = None,
+        exception: BaseException | None = None,
+    ):
+        if not future.done():
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        with self._inflight_lock:
+            del self._inflight[key]
+
+    async def _single_flight(self, key: tuple[str, str], download) -> Any:
+        """Runs `download()` once for every concurrent caller sharing `key`
+
+        Futures from `concurrent.futures` are used because Flask runs each
+        request in its own event loop.
+        """
+        future, owner = self._claim_inflight(key)
+        if not owner:
+            self._logger.debug("Waiting for in-flight download {}".format(key))
+            return await asyncio.wrap_future(future)
+        try:
+            result = await download()
+        except Exception as e:
+            self._release_inflight(key, future, exception=e)
+            raise
+        except BaseException:
+            self._release_inflight(
+                key, future, exception=DownloadError("Download was cancelled")
+            )
+            raise
+        self._release_inflight(key, future, result=result)
+        return result
+
+    async def _fetch_illust(self, url: str) -> bytes:
+        image_bytes = BytesIO()
+        await self._downloader.download(url, image_bytes)
+        return image_bytes.getvalue()
+
+    async def _fetch_illust_to_cache(self, url: str, path: Path):
+        file = self._path.joinpath(path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file so a partial download is never served.
+        part = file.with_name(file.name + ".part")
+        try:
+            with part.open("wb") as f:
+                await self._downloader.download(url, f)
+            part.replace(file)
+        finally:
+            part.unlink(missing_ok=True)
+        self._cache.add(path)
+
+    @STAGE_SECONDS.time(stage="download_illust")
     async def _download_illust(
         self, url: str, path: Path | None = None
     ) -> tuple[BytesIO | None, str]:
-        if path:
-            path = self._path.joinpath(path).parent
-            path.mkdir(parents=True, exist_ok=True)
-            image_bytes = None
-        else:
-            image_bytes = BytesIO()
         image_name = PurePath(url).name
-        await asyncio.to_thread(
-            self._pixiv.download, url, path=str(path), fname=image_bytes
+        if path:
+            await self._single_flight(
+                ("file", url), lambda: self._fetch_illust_to_cache(url, Path(path))
+            )
+            return None, image_name
+        image_bytes = await self._single_flight(
+            ("bytes", url), lambda: self._fetch_illust(url)
+        )
+        return BytesIO(image_bytes), image_name
+
+    def _fits(self, url: str, data: bytes) -> bool:
+        try:
+            return fits(data)
+        except UNREADABLE as e:
+            # Let Telegram decide what to do with it.
+            self._logger.warning("Failed to read {}: {}".format(url, e))
+            return True
+
+    async def _store_fitted(
+        self, url: str, data: bytes, fitted: Path
+    ) -> bytes | None:
+        """Downscales `data` in the resize pool and caches it as `fitted`
+
+        Returns None if the image can't be decoded, the original is sent then.
+        """
+        self._logger.debug("Downscaling {} ({} bytes)".format(url, len(data)))
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                self._resize_pool, fit_photo, data
+            )
+        except UNREADABLE as e:
+            self._logger.warning("Failed to downscale {}: {}".format(url, e))
+            return None
+        file = self._path.joinpath(fitted)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        part = file.with_name(file.name + ".part")
+        part.write_bytes(data)
+        part.replace(file)
+        self._cache.add(fitted)
+        return data
+
+    @staticmethod
+    def _fitted_path(path: Path) -> Path:
+        return path.with_name(path.stem + "_fit.jpg")
+
+    async def _download_fitted_illust(self, url: str) -> tuple[BytesIO, str]:
+        """Downloads an illust, downscaled if it doesn't fit Telegram's limits
+
+        Downscaled images are cached next to where the original would be.
+        """
+        fitted = self._fitted_path(Path(urlparse(url).path[1:]))
+        if self._cache.lookup(fitted):
+            return BytesIO(self._path.joinpath(fitted).read_bytes()), fitted.name
+        image, image_name = await self._download_illust(url)
+        data = image.getvalue()
+        if self._fits(url, data):
+            return image, image_name
+        data = await self._store_fitted(url, data, fitted)
+        if data is None:
+            return image, image_name
+        return BytesIO(data), fitted.name
+
+    async def _cache_fitted_illust(self, url: str, path: Path) -> Path:
+        """Caches `url` at `path`, returns the cache path of the version to send
+
+        That's the original if it fits Telegram's photo limits, its downscaled
+        version otherwise. Used when photos are sent by URL (`/raw?fit=1`).
+        """
+        fitted = self._fitted_path(path)
+        if self._cache.lookup(fitted):
+            return fitted
+        if not self._cache.lookup(path):
+            await self._download_illust(url=url, path=path)
+        data = self._path.joinpath(path).read_bytes()
+        if self._fits(url, data):
+            return path
+        data = await self._single_flight(
+            ("fit", url), lambda: self._store_fitted(url, data, fitted)
         )
-        return image_bytes, image_name
-
-    async def _download_ugoira(self, url: str) -> Path:
-        file_name = PurePath(url).name
-        file_stem = PurePath(url).stem
-        await asyncio.to_thread(self._pixiv.download, url, path=str(self._ugoira_cache))
-        file_path = self._ugoira_cache.joinpath(file_name)
-        extract_path = self._ugoira_cache.joinpath(file_stem)
-        extract_path.mkdir(exist_ok=True)
+        return path if data is None else fitted
+
+    async def _download_ugoira(self, url: str, dest: Path) -> Path:
+        """Downloads the ugoira ZIP to `dest` and extracts its frames there"""
+        file_path = dest.joinpath(PurePath(url).name)
+        with file_path.open("wb") as f:
+            await self._downloader.download(url, f)
+        extract_path = dest.joinpath(PurePath(url).stem)
+        extract_path.mkdir()
         with ZipFile(file_path, "r") as f:
             f.extractall(extract_path)
         return extract_path
 
-    async def _convert_ugoira_to_webm(self, ugoira_path: Path, fps: float) -> Path:
-        converted = self._ugoira_cache.joinpath("converted")
-        converted.mkdir(exist_ok=True)
-        out = converted.joinpath(ugoira_path.with_suffix(".webm").name)
-        args = ["ffmpeg", "-y", "-c:v", "libvpx-vp9"]
-        for image in ugoira_path.iterdir():
-            args += ["-i", f"{image}"]
-        args += ["-r", f"{int(fps)}", f"{out}"]
+    @STAGE_SECONDS.time(stage="ugoira_convert")
+    async def _convert_ugoira_extracted(
+        self, ugoira_path: Path, frames: list[dict], out: Path, profile: EncoderProfile
+    ) -> Path:
+        """Encodes the extracted frames with their exact delays
+
+        Frames are fed to ffmpeg as a single sequence using the concat demuxer,
+        each one lasting its own delay (in milliseconds).
+        """
+        concat = ugoira_path.joinpath("ffconcat.txt")
+        lines = ["ffconcat version 1.0"]
+        for frame in frames:
+            lines.append("file '{}'".format(frame["file"]))
+            lines.append("duration {}".format(frame["delay"] / 1000))
+        # The last frame has to be repeated for its duration to be applied.
+        lines.append("file '{}'".format(frames[-1]["file"]))
+        concat.write_text("\n".join(lines) + "\n")
+        part = out.with_name(out.name + ".part")
+        args = ["ffmpeg", "-y", "-f", "concat", "-i", f"{concat}"]
+        args += ugoira_output_args(profile, part, [])
         proc = await asyncio.create_subprocess_exec(*args)
         retcode = await proc.wait()
         if retcode != 0:
+            part.unlink(missing_ok=True)
             raise RuntimeError("Convert error")
+        part.replace(out)
         return out
 
-    async def get_video_from_ugoira(self, illust_id: int, ugoira: dict = None) -> Path:
+    @STAGE_SECONDS.time(stage="ugoira_convert")
+    async def _convert_ugoira_pipe(
+        self, url: str, frames: list[dict], out: Path, profile: EncoderProfile
+    ) -> Path:
+        """Encodes an ugoira by piping the frames straight from its ZIP
+
+        The ZIP is kept in memory (spilling to a temporary file for big ones)
+        and deleted once encoded, so no per-frame file is ever written.
+        """
+        with SpooledTemporaryFile(
+            max_size=self._ugoira_memory_limit, dir=self._ugoira_cache
+        ) as archive:
+            await self._downloader.download(url, archive)
+            archive.seek(0)
+            return await encode_ugoira_zip(archive, frames, out, profile)
+
+    async def get_video_from_ugoira(
+        self, illust_id: int, ugoira: dict = None, profile: str | None = None
+    ) -> Path:
+        """Converts an ugoira to a video using an encoder profile (see `PROFILES`)"""
         logger = self._logger.getChild("get_video_from_ugoira")
+        profile = profile or self._ugoira_profile
+        try:
+            encoder = PROFILES[profile]
+        except KeyError:
+            raise ValueError("Unknown encoder profile: {}".format(profile))
         if not ugoira:
             ugoira = await self.get_ugoira_from_id(illust_id=illust_id)
         logger.debug(ugoira)
-        frm_delay = 0
-        for frame in ugoira["body"]["frames"]:
-            frm_delay += frame["delay"]
-        fps = 1000 / (frm_delay / len(ugoira["body"]["frames"]))
-        dl_path = await self._download_ugoira(ugoira["body"]["originalSrc"])
-        video = await self._convert_ugoira_to_webm(dl_path, fps=fps)
+        src = ugoira["body"]["originalSrc"]
+        # Videos share the image cache budget, keyed by the source ZIP too since
+        # it changes when the ugoira is edited.
+        path = Path("ugoira-videos").joinpath(
+            "{}-{}-{}.{}".format(illust_id, PurePath(src).stem, profile, encoder.extension)
+        )
+        video = self._path.joinpath(path)
+        if self._cache.lookup(path):
+            logger.debug("Serving cached video {}".format(video))
+            return video
+        video.parent.mkdir(exist_ok=True)
+        if self._ugoira_pipe:
+            await self._convert_ugoira_pipe(
+                src, frames=ugoira["body"]["frames"], out=video, profile=encoder
+            )
+        else:
+            # The ZIP and its frames are only needed by this conversion, and the
+            # same ugoira may be converted to another profile at the same time.
+            with TemporaryDirectory(dir=self._ugoira_cache) as tmp:
+                dl_path = await self._download_ugoira(src, Path(tmp))
+                await self._convert_ugoira_extracted(
+                    dl_path, frames=ugoira["body"]["frames"], out=video, profile=encoder
+                )
+        self._cache.add(path)
         return video
 
-    async def get_ugoira_from_id(self, illust_id: int) -> dict:
-        ugoira: dict = self._pixiv.no_auth_requests_call(
-            "GET", "https://www.pixiv.net/ajax/illust/{}/ugoira_meta".format(illust_id)
-        ).json()
+    def convert_ugoira(self, illust_id: int, profile: str | None = None) -> Job:
+        """Queues the ugoira video conversion, merged with a pending one"""
+        return self._ugoira_jobs.submit((int(illust_id), profile or self._ugoira_profile))
+
+    async def _fetch_ugoira_meta(self, illust_id: int) -> dict:
+        try:
+            body = await self._downloader.get(
+                "https://www.pixiv.net/ajax/illust/{}/ugoira_meta".format(illust_id),
+                # Errors come with a JSON body telling what went wrong.
+                raise_for_status=False,
+                headers={
+                    "Referer": "https://www.pixiv.net/",
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36",
+                },
+            )
+            ugoira: dict = json.loads(body)
+        except (DownloadError, ValueError) as e:
+            raise GetUgoiraError("Failed to get ugoira metadata: {}".format(e))
         if ugoira["error"]:
             if ugoira["message"] == "The ID you provided is not an Ugoira":
                 raise NotAnUgoiraError(ugoira["message"])
             raise GetUgoiraError(ugoira["message"])
         return ugoira
 
+    async def get_ugoira_from_id(self, illust_id: int) -> dict:
+        """Returns the ugoira metadata (frames, ZIP URLs...)
+
+        Frame metadata never changes, so it's stored on disk for good.
+        """
+        illust_id = int(illust_id)
+        meta_path = self._ugoira_meta.joinpath("{}.json".format(illust_id))
+        try:
+            return json.loads(meta_path.read_text())
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            self._logger.warning("Ignoring corrupted ugoira metadata {}".format(meta_path))
+
+        async def fetch() -> dict:
+            ugoira = await self._fetch_ugoira_meta(illust_id)
+            part = meta_path.with_name(meta_path.name + ".part")
+            part.write_text(json.dumps(ugoira))
+            part.replace(meta_path)
+            return ugoira
+
+        return await self._single_flight(("ugoira_meta", str(illust_id)), fetch)
+
     async def get_ugoira(self, illust: dict) -> dict:
         if illust["type"] != "ugoira":
             raise NotAnUgoiraError("The ID you provided is not an Ugoira")
         return await self.get_ugoira_from_id(illust_id=illust["id"])
 
+    def _remember_illusts(self, illusts: list[dict]):
+        """Learns from every illust we get from Pixiv"""
+        for illust in illusts:
+            self._illusts.put(int(illust["id"]), illust)
+        try:
+            self._tags.learn(illusts)
+        except (KeyError, TypeError):
+            pass
+
     async def get_illust_from_id(self, illust_id: int) -> dict:
+        illust = self._illusts.get(int(illust_id))
+        if illust is not None:
+            return illust
         try:
-            illust = (await asyncio.to_thread(self._pixiv.illust_detail, illust_id))[
+            illust = (await self._app_call(self._pixiv.illust_detail, illust_id))[
                 "illust"
             ]
         except KeyError as e:
             raise GetIllustrationError("Failed to get illust with error: {}".format(e))
+        self._remember_illusts([illust])
         return illust
 
     @staticmethod
@@ -188,7 +517,14 @@ class Pixiv:
         quality: str = "original",
         limit: int | None = None,
         to_url: bool | None = False,
+        fit: bool = False,
     ):
+        """Downloads the illust pages as (BytesIO, filename)
+
+        + `to_url`: return (URL, filename) instead, without downloading anything
+        + `fit`: downscale the images which are over Telegram's photo limits
+        """
+        download = self._download_fitted_illust if fit else self._download_illust
         if limit is not None and pictures is not None and len(pictures) > limit:
             raise DownloadError(
                 "Images list exceeded limit ({} while limit is {})".format(
@@ -217,9 +553,7 @@ class Pixiv:
                             )
                         )
                     else:
-                        images_job.append(
-                            self._download_illust(page["image_urls"][quality])
-                        )
+                        images_job.append(download(page["image_urls"][quality]))
             if to_url:
                 images = images_job
             else:
@@ -237,7 +571,7 @@ class Pixiv:
             images = [(illust_dl, PurePath(illust_dl).name)]
         else:
             try:
-                images = [await self._download_illust(illust_dl)]
+                images = [await download(illust_dl)]
             except PixivError as e:
                 raise DownloadError(e)
         return images
@@ -259,6 +593,7 @@ class Pixiv:
             tags.append(tag["translated_name"])
         return tags
 
+    @STAGE_SECONDS.time(stage="tag_matching")
     def _image_from_tag_matching(
         self,
         images,
@@ -266,103 +601,87 @@ class Pixiv:
         exclude_tags: list[str] | set[str] | None = None,
     ) -> dict:
         logger = self._logger.getChild("image_from_tag_matching")
-        logger.debug("Using hacky image matching algorithm...")
         if tags is None:
             return images[randint(0, len(images) - 1)]
-        if exclude_tags is None:
-            exclude_tags = set()
-        else:
-            exclude_tags = set(x.lower()[1:] for x in exclude_tags)
-        tags = set(x.lower() for x in tags)
-        image = None
-        searched_images = []
-        while image is None:
-            logger.debug(f"Previous image: {searched_images}")
-            if len(searched_images) == len(images):
-                raise SearchError("Couldn't find any images matching provided keywords")
-            while True:
-                logger.debug(f"Image array size: {len(images)}")
-                image_count = randint(0, len(images) - 1)
-                logger.debug(f"Selecting image: {image_count}")
-                if image_count not in searched_images:
-                    break
-            logger.debug(f"Current selected image: {image_count}")
-            searched_images.append(image_count)
-            current_image = images[image_count]
-            logger.debug(f"Raw tags: {self.get_raw_tags(current_image)}")
-            r18_image = "R-18" in self.get_raw_tags(current_image)
-            if r18_image and "r-18" not in tags:
-                logger.debug("Image is a R-18 but we don't want R-18")
-                continue
-            elif not r18_image and "r-18" in tags:
-                logger.debug("Image is not a R-18 image but we wanted R-18")
-                continue
-            logger.debug("Begin tag partial matching")
-            found_tags = set()
-            found_bl_tags = set()
-            # Found tags for joined words.
-            found_tags_jw = set()
-            for tag in current_image["tags"]:
-                logger.debug(f"Comparing with {tag['name']} ({tag['translated_name']})")
-                if exclude_tags:
-                    for kw in exclude_tags:
-                        kw_set = set(kw.split(" "))
-                        logger.debug(f"Current blacklist keyword: {kw_set}")
-                        if tag["translated_name"] is not None and kw_set.issubset(
-                            tag["translated_name"].lower().split(" ")
-                        ):
-                            found_bl_tags.add(kw)
-                            continue
-                        if kw_set.issubset(tag["name"].lower().split(" ")):
-                            found_bl_tags.add(kw)
-                            continue
-                # Keyword in out specified tags
-                for kw in tags:
-                    # Normal search
-                    kw_list = kw.split(" ")
-                    kw_set = set(kw_list)
-                    if tag["translated_name"] is not None and kw_set.issubset(
-                        tag["translated_name"].lower().split(" ")
-                    ):
-                        found_tags.add(kw)
-                        continue
-                    if kw_set.issubset(tag["name"].lower().split(" ")):
-                        found_tags.add(kw)
-                        continue
-
-                    # Conjoined words
-                    kw_joined = "".join(kw_list)
-                    kw_check_list = [kw_joined]
-                    if len(kw_list) == 2:
-                        kw_list[0], kw_list[1] = kw_list[1], kw_list[0]
-                        kw_joined_swap = "".join(kw_list)
-                        kw_check_list.append(kw_joined_swap)
-                    if tag["name"].lower() in kw_check_list:
-                        found_tags_jw.add(kw)
-                        continue
-                    if (
-                        tag["translated_name"] is not None
-                        and tag["translated_name"].lower() in kw_check_list
-                    ):
-                        found_tags_jw.add(kw)
-                        continue
-
-            found_tags.update(found_tags_jw)
-            logger.debug(f"Final found tags & defined tags: {found_tags}, {tags}")
-            if tags == found_tags:
-                if found_bl_tags and found_bl_tags.issubset(exclude_tags):
-                    logging.debug("Illust contains blacklisted words, not using")
-                    continue
-                image = current_image
+        matcher = TagMatcher(tags, exclude_tags)
+        logger.debug(
+            "Matching {} images against {} (excluding {})".format(
+                len(images), matcher.tags, matcher.exclude_tags
+            )
+        )
+        image = matcher.select(images)
         logger.debug("Found the illust we are maybe looking for")
         return image
 
+    async def _fetch_related(self, illust_id: int) -> list[dict]:
+        try:
+            result = (await self._app_call(self._pixiv.illust_related, illust_id))[
+                "illusts"
+            ]
+        except KeyError as e:
+            raise SearchRelatedError(e)
+        self._remember_illusts(result)
+        return result
+
+    async def _related_illust_beam(
+        self, illust_id: int, matcher: TagMatcher, recurse: int, beam: int
+    ) -> dict:
+        """Beam search over related illusts
+
+        Each hop expands up to `beam` illusts concurrently. The next hop starts
+        as soon as enough matching candidates are found, and on the last hop the
+        first matching illust wins. Pending expansions are cancelled.
+        """
+        logger = self._logger.getChild("related_illust_beam")
+        visited = {int(illust_id)}
+        frontier = [int(illust_id)]
+        for hop in range(recurse + 1):
+            started = time.perf_counter()
+            last_hop = hop == recurse
+            logger.debug("Hop {}, expanding {}".format(hop, frontier))
+            tasks = [
+                asyncio.create_task(self._fetch_related(node)) for node in frontier
+            ]
+            candidates: list[dict] = []
+            try:
+                for task in asyncio.as_completed(tasks):
+                    try:
+                        result = await task
+                    except SearchError as e:
+                        logger.debug("Branch failed: {}".format(e))
+                        continue
+                    for image in matcher.filter(result):
+                        if image["id"] in visited:
+                            continue
+                        visited.add(image["id"])
+                        candidates.append(image)
+                    if len(candidates) >= (1 if last_hop else beam):
+                        break
+            finally:
+                for task in tasks:
+                    task.cancel()
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="related_hop")
+            if not candidates:
+                raise SearchRelatedError(
+                    "Couldn't find any related images matching provided keywords"
+                )
+            if last_hop:
+                return candidates[0]
+            frontier = [image["id"] for image in candidates[:beam]]
+
     async def related_illust(
         self,
         illust_id: int,
         tags: list[str] | set[str] | None = None,
         recurse: int | None = None,
+        beam: int | None = None,
     ) -> dict:
+        """Searches for a related illust matching the tags
+
+        With `recurse`, the search is repeated from the found illust. With
+        `beam` greater than 1, up to `beam` illusts are expanded concurrently
+        at each hop (see `_related_illust_beam`).
+        """
         logger = self._logger.getChild("related_illust")
         if recurse is None:
             recurse = 0
@@ -377,13 +696,13 @@ class Pixiv:
         logger.debug(
             "ID: {}, tags: {}, exclude_tags: {}".format(illust_id, tags, exclude_tags)
         )
-        try:
-            result = (await asyncio.to_thread(self._pixiv.illust_related, illust_id))[
-                "illusts"
-            ]
-            logger.debug("{}".format(result))
-        except KeyError as e:
-            raise SearchRelatedError(e)
+        if beam is not None and beam > 1:
+            return await self._related_illust_beam(
+                illust_id, TagMatcher(tags, exclude_tags), recurse=recurse, beam=beam
+            )
+        started = time.perf_counter()
+        result = await self._fetch_related(illust_id)
+        logger.debug("{}".format(result))
 
         try:
             image = self._image_from_tag_matching(
@@ -391,6 +710,8 @@ class Pixiv:
             )
         except SearchError as e:
             raise SearchRelatedError(e)
+        finally:
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="related_hop")
         if image["id"] == illust_id:
             raise SearchRelatedError(
                 "Related image has the same ID as the original image."
@@ -420,18 +741,20 @@ class Pixiv:
         image: dict | None = None
         while image is None and attempt < max_attempt:
             logger.debug("Search attempt: {}".format(attempt))
+            started = time.perf_counter()
             if sort is None:
                 sort = ["date_desc", "popular_desc"][randint(0, 1)]
             logger.debug(sort)
             try:
                 result = (
-                    await asyncio.to_thread(
+                    await self._app_call(
                         self._pixiv.search_illust,
                         " ".join(tags),
                         sort=sort,
                         filter=filter,
                     )
                 )["illusts"]
+                self._remember_illusts(result)
                 image = self._image_from_tag_matching(
                     result, tags=tags, exclude_tags=exclude_tags
                 )
@@ -455,11 +778,110 @@ class Pixiv:
                         image = related_image
             except (KeyError, SearchError):
                 pass
+            STAGE_SECONDS.observe(time.perf_counter() - started, stage="search_attempt")
             attempt += 1
         if image is None:
             raise SearchError("No images matches specified tags")
         return image
 
+    @staticmethod
+    def _search_pool_key(
+        tags: list[str] | set[str], related: bool, sort: str | None
+    ) -> tuple:
+        exclude_tags = set(x for x in tags if x.startswith("-"))
+        matcher = TagMatcher(set(tags) - exclude_tags, exclude_tags)
+        return (
+            tuple(sorted(matcher.tags)),
+            tuple(sorted(matcher.exclude_tags)),
+            sort,
+            related,
+        )
+
+    def _get_search_pool(
+        self, tags: list[str] | set[str], related: bool, sort: str | None
+    ) -> SearchPool:
+        key = self._search_pool_key(tags, related, sort)
+        pool = self._search_pools.get(key)
+        if pool is None:
+            exclude_tags = set(x for x in tags if x.startswith("-"))
+            tags = set(tags) - exclude_tags
+            matcher = TagMatcher(tags, exclude_tags)
+            if sort is None:
+                sort = ["date_desc", "popular_desc"][randint(0, 1)]
+            pool = SearchPool(" ".join(tags), matcher, sort=sort, related=related)
+            self._search_pools.put(key, pool)
+        return pool
+
+    @STAGE_SECONDS.time(stage="search_attempt")
+    async def _fill_search_pool(self, pool: SearchPool):
+        if pool.next_url:
+            kwargs = self._pixiv.parse_qs(pool.next_url)
+        else:
+            kwargs = {
+                "word": pool.word,
+                "sort": pool.sort,
+                "filter": "",
+            }
+        rsp = await self._app_call(self._pixiv.search_illust, **kwargs)
+        try:
+            result = rsp["illusts"]
+        except KeyError as e:
+            raise SearchError("Failed to search for images: {}".format(e))
+        self._remember_illusts(result)
+        pool.started = True
+        pool.next_url = rsp.get("next_url")
+        added = pool.add_seeds(result)
+        self._logger.getChild("search_pool").debug(
+            "Fetched {} illusts, {} matching".format(len(result), added)
+        )
+
+    def return_search_result(
+        self,
+        tags: list[str] | set[str],
+        illust: dict,
+        related: bool = True,
+        sort: str | None = None,
+    ):
+        """Gives back a result of `search_illust(pool=True)` which wasn't used
+
+        It's served again by the next search, if its pool is still around.
+        """
+        pool = self._search_pools.get(self._search_pool_key(tags, related, sort))
+        if pool is not None:
+            pool.ready.append(illust)
+
+    async def _search_illust_pooled(
+        self, tags: list[str] | set[str], related: bool, sort: str | None, max_attempt: int
+    ) -> dict:
+        logger = self._logger.getChild("search_pool")
+        pool = self._get_search_pool(tags, related=related, sort=sort)
+        async with pool.lock:
+            for attempt in range(max_attempt):
+                if pool.ready:
+                    logger.debug("Serving from pool ({} left)".format(len(pool.ready)))
+                    return pool.ready.pop()
+                if pool.seeds:
+                    seed = pool.seeds.pop()
+                    if not pool.related:
+                        return seed
+                    try:
+                        pool.add_ready(await self._fetch_related(seed["id"]))
+                    except SearchError:
+                        pass
+                    if pool.ready:
+                        return pool.ready.pop()
+                    logger.debug("No related images matching, using searched image")
+                    return seed
+                if pool.exhausted:
+                    logger.debug("Pool exhausted, starting over...")
+                    pool.reset()
+                logger.debug("Search attempt: {}".format(attempt))
+                try:
+                    await self._fill_search_pool(pool)
+                except (PixivError, SearchError) as e:
+                    logger.debug("Search failed: {}".format(e))
+        raise SearchError("No images matches specified tags")
+
     @staticmethod
     def _translate_tag_legacy(img, tag) -> str:
         # print(img["tags"])
@@ -498,19 +920,21 @@ class Pixiv:
         logger.debug("Final translated tags {}".format(tl_tags))
         return tl_tags
 
-    def _translate_tag(self, tag_kw: set[str], kw: str) -> str:
-        # TODO: Rewrite using aiohttp
+    async def _translate_tag(self, tag_kw: set[str], kw: str) -> str | None:
         tag_name: str | None = None
-        r = self._session.get(
-            "https://www.pixiv.net/rpc/cps.php",
-            params={"keyword": kw, "lang": "en"},
-            headers={
-                "Referer": "https://www.pixiv.net/en/",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36",
-            },
-        )
-        r.raise_for_status()
-        suggestions = r.json()
+        try:
+            body = await self._downloader.get(
+                "https://www.pixiv.net/rpc/cps.php",
+                params={"keyword": kw, "lang": "en"},
+                headers={
+                    "Referer": "https://www.pixiv.net/en/",
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36",
+                },
+            )
+            suggestions = json.loads(body)
+        except (DownloadError, ValueError) as e:
+            self._logger.warning("Failed to query tag {}: {}".format(kw, e))
+            return None
         for candidate in suggestions["candidates"]:
             if candidate["type"] != "tag_translation":
                 continue
@@ -519,54 +943,82 @@ class Pixiv:
                 break
         return tag_name
 
+    async def _translate_tag_pipeline(self, tag: str) -> str | None:
+        """Pixiv query search, then first word search if the former failed"""
+        logger: logging.Logger = self._logger.getChild("translate_tags")
+        tag_list: list[str] = tag.lower().split(" ")
+        tag_kw: set[str] = set(tag_list)
+        if len(tag_list) > 1:
+            tag_list[-1] = tag_list[-1][: int(len(tag_list[-1]) / 2)]
+        px_search = " ".join(tag_list)
+        logger.debug("Generated Pixiv search query: {}".format(px_search))
+        tl_tag_name = await self._translate_tag(tag_kw=tag_kw, kw=px_search)
+        if tl_tag_name is None:
+            logger.debug(
+                "Pixiv query search failed, using first word in tag to search..."
+            )
+            tl_tag_name = await self._translate_tag(tag_kw=tag_kw, kw=tag_list[0])
+        return tl_tag_name
+
+    @STAGE_SECONDS.time(stage="translate_tags")
     async def translate_tags(self, tags: list[str], fallback: bool = True) -> list[str]:
         """
         Experimental tags translation using Pixiv Ajax API
+
+        Tags are translated concurrently, the (slow) legacy method is only used
+        for tags which couldn't be translated otherwise.
         """
         logger: logging.Logger = self._logger.getChild("translate_tags")
-        tl_tags: list[str] = []
-        for tag in tags:
+        tl_tags: list[str | None] = [None] * len(tags)
+        jobs: dict[int, Coroutine] = {}
+        for index, tag in enumerate(tags):
             if tag in ["R-18"]:
                 logger.debug("Known tag: {}, not translating...".format(tag))
-                tl_tags.append(tag)
-                continue
-            logger.debug("Translating tag: {}".format(tag))
-            exclude_tag: bool = False
-            if tag.startswith("-"):
+                tl_tags[index] = tag
+            elif tag.startswith("-"):
+                # Exclude tags are matched against the translated name anyway.
                 logger.debug("Exclude tag detected.")
-                tag = tag[1:]
-                exclude_tag = True
-            tag_name: str = tag
-            tag = tag.lower()
-            tag_list: list[str] = tag.split(" ")
-            tag_kw: set[str] = set(tag_list)
-            if len(tag_list) > 1:
-                tag_list[-1] = tag_list[-1][: int(len(tag_list[-1]) / 2)]
-            px_search = " ".join(tag_list)
-            logger.debug("Generated Pixiv search query: {}".format(px_search))
-            tl_tag_name = self._translate_tag(tag_kw=tag_kw, kw=px_search)
-            if tl_tag_name is None:
-                logger.debug(
-                    "Pixiv query search failed, using first word in tag to search..."
-                )
-                tl_tag_name = (
-                    self._translate_tag(tag_kw=tag_kw, kw=tag_list[0])
-                )
-            if tl_tag_name is None:
-                logger.debug(
-                    "Pixiv query search failed after retrying."
+                tl_tags[index] = "-" + tag[1:].lower()
+            else:
+                known, tl_tag_name = self._tags.get(tag, fallback=fallback)
+                if known:
+                    logger.debug("Known translation: {} -> {}".format(tag, tl_tag_name))
+                    tl_tags[index] = tl_tag_name if tl_tag_name is not None else tag
+                    continue
+                logger.debug("Translating tag: {}".format(tag))
+                jobs[index] = self._translate_tag_pipeline(tag)
+        for index, tl_tag_name in zip(jobs, await asyncio.gather(*jobs.values())):
+            tl_tags[index] = tl_tag_name
+            if tl_tag_name is not None:
+                self._tags.put(tags[index], tl_tag_name, "cps")
+        failed = [index for index in jobs if tl_tags[index] is None]
+        if failed:
+            logger.debug(
+                "Pixiv query search failed after retrying: {}".format(
+                    [tags[index] for index in failed]
                 )
-                if fallback:
-                    logger.debug(
-                        "Using fallback method to search..."
-                    )
-                    tl_tag_name = (await self.translate_tags_legacy([tag_name]))[0]
+            )
+            legacy = [tags[index] for index in failed]
+            if fallback:
+                logger.debug("Using fallback method to search...")
+                for position, index in enumerate(failed):
+                    # Per tag, so one without any illust keeps the others.
+                    try:
+                        legacy[position] = (
+                            await self.translate_tags_legacy([tags[index]])
+                        )[0]
+                    except SearchError as e:
+                        logger.debug(
+                            "Fallback failed for {}: {}".format(tags[index], e)
+                        )
+            for index, tl_tag_name in zip(failed, legacy):
+                tl_tags[index] = tl_tag_name
+                if tl_tag_name != tags[index]:
+                    self._tags.put(tags[index], tl_tag_name, "legacy")
                 else:
-                    tl_tag_name = tag_name
-            if exclude_tag:
-                tl_tag_name = "-" + tag
-            logger.debug("Translated tag: {}".format(tl_tag_name))
-            tl_tags.append(tl_tag_name)
+                    self._tags.put(
+                        tags[index], None, "legacy" if fallback else "cps"
+                    )
         logger.debug("Final translated tags: {}".format(str(tl_tags)))
         return tl_tags
 
@@ -577,11 +1029,21 @@ class Pixiv:
         sort=None,
         max_attempt=None,
         max_related_attempt=None,
+        pool: bool = False,
     ):
+        """Searches for an illust matching the tags
+
+        With `pool`, unused matching results are kept (per tags, sort and
+        related flag) and served by the next calls before searching Pixiv again.
+        """
         if tags is None:
             raise SearchError("No tags specified.")
         max_attempt = 5 if not max_attempt else max_attempt
         max_related_attempt = 5 if not max_related_attempt else max_related_attempt
+        if pool:
+            return await self._search_illust_pooled(
+                tags=tags, related=related, sort=sort, max_attempt=max_attempt
+            )
         return await self._search_illust(
             tags=tags,
             related=related,
@@ -603,13 +1065,301 @@ class Pixiv:
         image = await self.search_illust(tags, related=related)
         return self.download_illust(image["id"], page_list)
 
+    async def _stream_illust_to_cache(self, url: str, path: Path) -> Response | None:
+        """Relays `url` to the client while writing it to the cache
+
+        The file is only committed to the cache once the whole image has been
+        received. Returns None if another download of `url` was in flight, the
+        file is cached once this returns.
+        """
+        key = ("file", url)
+        future, owner = self._claim_inflight(key)
+        if not owner:
+            await asyncio.wrap_future(future)
+            return None
+        try:
+            bucket = self._limiter.for_host(urlparse(url).hostname)
+            await bucket.acquire()
+            upstream = await asyncio.to_thread(
+                self._pixiv.requests_call,
+                "GET",
+                url,
+                headers={"Referer": "https://app-api.pixiv.net/"},
+                stream=True,
+            )
+            self._limiter.report(
+                bucket, upstream.status_code, upstream.headers.get("Retry-After")
+            )
+            if upstream.status_code != 200:
+                upstream.close()
+                raise DownloadError(
+                    "Upstream returned status code {}".format(upstream.status_code)
+                )
+        except Exception as e:
+            error = e if isinstance(e, DownloadError) else DownloadError(e)
+            self._release_inflight(key, future, exception=error)
+            raise error
+        file = self._path.joinpath(path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        part = file.with_name(file.name + ".part")
+        logger = self._logger.getChild("stream")
+
+        started = False
+
+        def tee():
+            nonlocal started
+            started = True
+            host = urlparse(url).hostname
+            relay = True
+            written = 0
+            error = None
+            try:
+                with upstream, part.open("wb") as f:
+                    for chunk in upstream.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+                        written += len(chunk)
+                        DOWNLOAD_BYTES.inc(len(chunk), host=host)
+                        if not relay:
+                            continue
+                        try:
+                            yield chunk
+                        except GeneratorExit:
+                            # Client went away, finish the download for the cache.
+                            relay = False
+                expected = upstream.headers.get("Content-Length")
+                if expected is not None and int(expected) != written:
+                    raise DownloadError(
+                        "Incomplete download ({}/{} bytes)".format(written, expected)
+                    )
+                part.replace(file)
+                self._cache.add(path)
+            except Exception as e:
+                logger.warning("Failed to stream {}: {}".format(url, e))
+                error = e if isinstance(e, DownloadError) else DownloadError(e)
+            finally:
+                part.unlink(missing_ok=True)
+                self._release_inflight(key, future, exception=error)
+
+        def abandon():
+            # The body was never read (e.g. a HEAD request), so tee() never
+            # got to release the download.
+            if not started:
+                upstream.close()
+                self._release_inflight(
+                    key, future, exception=DownloadError("Download was abandoned")
+                )
+
+        headers = {"Cache-Control": self.CACHE_CONTROL}
+        if "Content-Length" in upstream.headers:
+            headers["Content-Length"] = upstream.headers["Content-Length"]
+        response = Response(
+            tee(),
+            mimetype=upstream.headers.get("Content-Type"),
+            headers=headers,
+        )
+        response.call_on_close(abandon)
+        return response
+
     async def download_illust_to_cache(self, illust_url: str):
         parsed = urlparse(illust_url)
         # Remove the root "/" in the path from url.
         path = Path(parsed.path[1:])
-        if not self._path.joinpath(path).is_file():
+        if not self._cache.lookup(path):
             await self._download_illust(url=illust_url, path=path)
 
+    def attach(self, loop: asyncio.AbstractEventLoop | None = None):
+        """Runs the downloads on `loop` (the running one by default)
+
+        Callers from other loops (Flask requests, ugoira jobs) are bridged to it.
+        """
+        self._downloader.attach(loop)
+
+    def cache_stats(self) -> dict:
+        return {
+            "images": self._cache.stats(),
+            "illusts": self._illusts.stats(),
+            "tags": self._tags.stats(),
+            "rate_limits": self._limiter.stats(),
+        }
+
+    async def _stream_illust_to_client(
+        self, request: web.Request, url: str, path: Path
+    ) -> web.StreamResponse | None:
+        """Same as _stream_illust_to_cache, for the aiohttp server
+
+        The image is downloaded through the shared downloader and relayed
+        without blocking a thread per client.
+        """
+        key = ("file", url)
+        future, owner = self._claim_inflight(key)
+        if not owner:
+            await asyncio.wrap_future(future)
+            return None
+        try:
+            headers, body = await self._downloader.stream(url)
+        except DownloadError as e:
+            self._release_inflight(key, future, exception=e)
+            raise
+        file = self._path.joinpath(path)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        part = file.with_name(file.name + ".part")
+        response = web.StreamResponse(
+            headers={
+                name: headers[name]
+                for name in ("Content-Type", "Content-Length")
+                if name in headers
+            }
+        )
+        response.headers["Cache-Control"] = self.CACHE_CONTROL
+        relay = True
+        written = 0
+        error = None
+        try:
+            try:
+                await response.prepare(request)
+            except ConnectionResetError:
+                relay = False
+            with part.open("wb") as f:
+                async for chunk in body:
+                    f.write(chunk)
+                    written += len(chunk)
+                    if not relay:
+                        continue
+                    try:
+                        await response.write(chunk)
+                    except ConnectionResetError:
+                        # Client went away, finish the download for the cache.
+                        relay = False
+            expected = headers.get("Content-Length")
+            if expected is not None and int(expected) != written:
+                raise DownloadError(
+                    "Incomplete download ({}/{} bytes)".format(written, expected)
+                )
+            part.replace(file)
+            self._cache.add(path)
+        except Exception as e:
+            self._logger.getChild("stream").warning(
+                "Failed to stream {}: {}".format(url, e)
+            )
+            error = e if isinstance(e, DownloadError) else DownloadError(e)
+        except BaseException:
+            error = DownloadError("Download was cancelled")
+            raise
+        finally:
+            await body.aclose()
+            part.unlink(missing_ok=True)
+            self._release_inflight(key, future, exception=error)
+        if error is not None:
+            if not response.prepared:
+                raise error
+            # Headers are gone already, all we can do is dropping the connection
+            # (send_cached would answer a 502 in the middle of the body).
+            raise ConnectionResetError(str(error)) from error
+        if relay:
+            await response.write_eof()
+        return response
+
+    @staticmethod
+    def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        for candidate in if_none_match.split(","):
+            candidate = candidate.strip().removeprefix("W/").strip('"')
+            if candidate == etag:
+                return True
+        return False
+
+    @staticmethod
+    def _raw_request_path(url: str | None) -> tuple[str, Path]:
+        """Validates the url query of /raw, returns (image URL, cache path)"""
+        if url is None:
+            raise BadRequestError("You need to pass an url query")
+        parsed = urlparse(url)
+        path = None
+        if parsed.netloc != "":
+            if parsed.netloc != "i.pximg.net":
+                raise BadRequestError("Must be a i.pximg.net url")
+        elif parsed.scheme == "":
+            if not parsed.path.startswith("i.pximg.net"):
+                raise BadRequestError("Must be a i.pximg.net url")
+            url = "https://" + parsed.path
+            path = parsed.path.removeprefix("i.pximg.net/")
+        else:
+            if not parsed.path.startswith("/i.pximg.net"):
+                raise BadRequestError("Must be a i.pximg.net url")
+            url = "https:/" + parsed.path
+            path = parsed.path.removeprefix("/i.pximg.net/")
+        if ".." in parsed.path:
+            raise BadRequestError("Illegal url provided", 403)
+        # Remove the root "/" in the path from url.
+        if path is None:
+            path = parsed.path[1:]
+        return url, Path(path)
+
+    async def _id_request_path(self, args: Mapping[str, str]) -> tuple[str, Path]:
+        """Resolves the queries of /id, returns (image URL, cache path)"""
+        # Workaround for illust_id url https://www.pixiv.net/member_illust.php?mode=medium&illust_id=xxxxxxxxx
+        px_id = args.get("illust_id") or args.get("id")
+        if px_id is None:
+            raise BadRequestError("You need to pass an id query")
+        px_id = self.get_id_from_str(px_id)[1]
+        if isinstance(px_id, str):
+            raise BadRequestError(px_id)
+        px_page = int(args.get("page") or 0)
+        px_quality = args.get("quality") or "original"
+        pic_url = (
+            await self.download_illust(
+                illust=await self.get_illust_from_id(px_id),
+                pictures=[px_page],
+                quality=px_quality,
+                to_url=True,
+            )
+        )[0][0]
+        # Remove "https://""
+        return pic_url, Path(pic_url[8:])
+
+    def _ugoira_request(self, args: Mapping[str, str]) -> tuple[int, str, float]:
+        """Validates the queries of /ugoira/video, returns (id, format, wait)"""
+        px_id = args.get("id")
+        if px_id is None:
+            raise BadRequestError("You need to pass an id query")
+        try:
+            px_id = int(px_id)
+            wait = float(args.get("wait") or 30)
+        except ValueError:
+            raise BadRequestError("Invalid id or wait query")
+        profile = args.get("format") or self._ugoira_profile
+        if profile not in PROFILES:
+            raise BadRequestError(
+                "Format must be one of: {}".format(", ".join(PROFILES))
+            )
+        return px_id, profile, wait
+
+    def _ugoira_status(
+        self, args: Mapping[str, str], route: str
+    ) -> tuple[dict, dict[str, str]]:
+        """Returns the status of the /ugoira/video job and the polling headers"""
+        try:
+            px_id = int(args.get("id"))
+        except (TypeError, ValueError):
+            raise BadRequestError("You need to pass a valid id query")
+        profile = args.get("format") or self._ugoira_profile
+        job = self._ugoira_jobs.get((px_id, profile))
+        if job is None:
+            raise BadRequestError("No conversion job for this id", 404)
+        status = job.to_dict()
+        status.update({"id": px_id, "format": profile})
+        query = "id={}&format={}".format(px_id, profile)
+        if job.status == "done":
+            status["url"] = "{}/ugoira/video?{}".format(route, query)
+        headers = {
+            "Location": "{}/ugoira/status?{}".format(route, query),
+            "Retry-After": "5",
+        }
+        return status, headers
+
     def flask_api(self, app: Flask, route: str | None = None):
         if not route:
             route = "/pixiv"
@@ -617,79 +1367,182 @@ class Pixiv:
         logger = self._logger.getChild("flask-api")
         logger.info("Initializing pixiv Flask route...")
 
+        async def send_cached(url: str, path: Path, fit: bool = False):
+            if fit:
+                try:
+                    path = await self._cache_fitted_illust(url, path)
+                except DownloadError as e:
+                    return str(e), 502
+            # Workaround because Flask treat the module path as the base path instead
+            full_path = Path("..").joinpath(self._path.joinpath(path))
+            if not self._cache.lookup(path):
+                try:
+                    # A HEAD response has no body to stream the image through.
+                    if self._stream_through and request.method != "HEAD":
+                        logger.info("File doesn't exist, streaming...")
+                        response = await self._stream_illust_to_cache(url, path)
+                        if response is not None:
+                            return response
+                    else:
+                        logger.info("File doesn't exist, downloading...")
+                        await self._download_illust(url=url, path=path)
+                except DownloadError as e:
+                    return str(e), 502
+            logger.info("Sending file...")
+            # Range and conditional requests are handled by send_file.
+            response = send_file(
+                path_or_file=full_path,
+                etag=self._cache.validator(path) or True,
+                download_name=path.name,
+                conditional=True,
+            )
+            response.headers["Cache-Control"] = self.CACHE_CONTROL
+            return response
+
+        @app.errorhandler(BadRequestError)
+        def pixiv_bad_request(e: BadRequestError):
+            return str(e), e.status
+
+        @app.route(route + "/cache/stats", methods=["GET"])
+        def pixiv_cache_stats_api():
+            return self.cache_stats()
+
         @app.route(route + "/ugoira/video", methods=["GET"])
         async def pixiv_ugoira_api():
             logger.info("Got a /pixiv/ugoira/video request")
-            px_id = request.args.get("id")
-            if px_id is None:
-                return "You need to pass an id query", 400
+            px_id, profile, wait = self._ugoira_request(request.args)
+            job = self.convert_ugoira(px_id, profile=profile)
             try:
-                video = await self.get_video_from_ugoira(px_id)
-            except GetUgoiraError as e:
+                video = await JobQueue.wait(job, timeout=wait)
+            except Exception as e:
                 return str(e), 500
+            if video is None:
+                # Still converting, let the client poll instead of waiting here.
+                status, headers = self._ugoira_status(request.args, route)
+                return status, 202, headers
             return send_file(path_or_file=Path("..").joinpath(video), etag=True, download_name=video.name)
 
+        @app.route(route + "/ugoira/status", methods=["GET"])
+        def pixiv_ugoira_status_api():
+            return self._ugoira_status(request.args, route)[0]
+
         @app.route(route + "/id", methods=["GET"])
         async def pixiv_id_api():
             logger.info("Got a /pixiv/id request")
-            # Workaround for illust_id url https://www.pixiv.net/member_illust.php?mode=medium&illust_id=xxxxxxxxx
-            if request.args.get("illust_id"):
-                px_id = self.get_id_from_str(request.args.get("illust_id"))[1]
-            else:
-                px_id = self.get_id_from_str(request.args.get("id"))[1]
-            if px_id is None:
-                return "You need to pass an id query", 400
-            if isinstance(px_id, str):
-                return px_id, 400
-            px_page = int(request.args.get("page") or 0)
-            px_quality = request.args.get("quality") or "original"
-            pic_url = (
-                await self.download_illust(
-                    illust=await self.get_illust_from_id(px_id), pictures=[px_page], quality=px_quality, to_url=True
-                )
-            )[0][0]
-            # Remove "https://""
-            path = Path(pic_url[8:])
-            # Workaround because Flask treat the module path as the base path instead
-            full_path = Path("..").joinpath(self._path.joinpath(path))
-            if not self._path.joinpath(path).is_file():
-                logger.info("File doesn't exist, downloading...")
-                await self._download_illust(url=pic_url, path=path)
-            logger.info("Sending file...")
-            return send_file(path_or_file=full_path, etag=True, download_name=path.name)
+            pic_url, path = await self._id_request_path(request.args)
+            return await send_cached(pic_url, path)
 
         @app.route(route + "/raw", methods=["GET"])
         async def pixiv_raw_api():
             logger.info("Got a /pixiv/raw request")
-            url = request.args.get("url")
-            if url is None:
-                return "You need to pass an url query", 400
-            parsed = urlparse(url)
-            path = None
-            if parsed.netloc != "":
-                if parsed.netloc != "i.pximg.net":
-                    return "Must be a i.pximg.net url", 400
-            elif parsed.scheme == "":
-                if not parsed.path.startswith("i.pximg.net"):
-                    return "Must be a i.pximg.net url", 400
-                url = "https://" + parsed.path
-                path = parsed.path.removeprefix("i.pximg.net/")
-            else:
-                if not parsed.path.startswith("/i.pximg.net"):
-                    return "Must be a i.pximg.net url", 400
-                url = "https:/" + parsed.path
-                path = parsed.path.removeprefix("/i.pximg.net/")
-            if ".." in parsed.path:
-                return "Illegal url provided", 403
+            url, path = self._raw_request_path(request.args.get("url"))
             logger.info("Got file: {}".format(url))
-            # Remove the root "/" in the path from url.
-            if path is None:
-                path = parsed.path[1:]
-            path = Path(path)
-            # Workaround because Flask treat the module path as the base path instead
-            full_path = Path("..").joinpath(self._path.joinpath(path))
-            if not self._path.joinpath(path).is_file():
-                logger.info("File doesn't exist, downloading...")
-                await self._download_illust(url=url, path=path)
+            return await send_cached(url, path, fit=bool(request.args.get("fit")))
+
+    def aiohttp_api(self, app: web.Application, route: str | None = None):
+        """Registers the same routes as flask_api on an aiohttp application
+
+        Handlers run in the event loop serving `app` (the bot's one when the
+        server is started from it), so concurrent clients don't need a thread
+        and an event loop each.
+        """
+        if not route:
+            route = "/pixiv"
+
+        logger = self._logger.getChild("aiohttp-api")
+        logger.info("Initializing pixiv aiohttp route...")
+
+        def send_file_response(path: Path) -> web.FileResponse:
+            return web.FileResponse(
+                path,
+                headers={
+                    "Content-Disposition": 'inline; filename="{}"'.format(path.name)
+                },
+            )
+
+        async def send_cached(
+            request: web.Request, url: str, path: Path, fit: bool = False
+        ):
+            if fit:
+                try:
+                    path = await self._cache_fitted_illust(url, path)
+                except DownloadError as e:
+                    return web.Response(text=str(e), status=502)
+            if not self._cache.lookup(path):
+                try:
+                    if self._stream_through:
+                        logger.info("File doesn't exist, streaming...")
+                        response = await self._stream_illust_to_client(
+                            request, url, path
+                        )
+                        if response is not None:
+                            return response
+                    else:
+                        logger.info("File doesn't exist, downloading...")
+                        await self._download_illust(url=url, path=path)
+                except DownloadError as e:
+                    return web.Response(text=str(e), status=502)
+            etag = self._cache.validator(path)
+            if etag is not None and self._etag_matches(
+                request.headers.get("If-None-Match"), etag
+            ):
+                return web.Response(
+                    status=304,
+                    headers={
+                        "ETag": '"{}"'.format(etag),
+                        "Cache-Control": self.CACHE_CONTROL,
+                    },
+                )
             logger.info("Sending file...")
-            return send_file(path_or_file=full_path, etag=True, download_name=path.name)
+            # Range and If-Modified-Since are handled by FileResponse, its ETag
+            # is the same as the stored validator.
+            response = send_file_response(self._path.joinpath(path))
+            response.headers["Cache-Control"] = self.CACHE_CONTROL
+            return response
+
+        @web.middleware
+        async def bad_request(request: web.Request, handler):
+            try:
+                return await handler(request)
+            except BadRequestError as e:
+                return web.Response(text=str(e), status=e.status)
+
+        async def pixiv_cache_stats_api(_: web.Request):
+            return web.json_response(self.cache_stats())
+
+        async def pixiv_ugoira_api(request: web.Request):
+            logger.info("Got a /pixiv/ugoira/video request")
+            px_id, profile, wait = self._ugoira_request(request.query)
+            job = self.convert_ugoira(px_id, profile=profile)
+            try:
+                video = await JobQueue.wait(job, timeout=wait)
+            except Exception as e:
+                return web.Response(text=str(e), status=500)
+            if video is None:
+                # Still converting, let the client poll instead of waiting here.
+                status, headers = self._ugoira_status(request.query, route)
+                return web.json_response(status, status=202, headers=headers)
+            return send_file_response(video)
+
+        async def pixiv_ugoira_status_api(request: web.Request):
+            return web.json_response(self._ugoira_status(request.query, route)[0])
+
+        async def pixiv_id_api(request: web.Request):
+            logger.info("Got a /pixiv/id request")
+            pic_url, path = await self._id_request_path(request.query)
+            return await send_cached(request, pic_url, path)
+
+        async def pixiv_raw_api(request: web.Request):
+            logger.info("Got a /pixiv/raw request")
+            url, path = self._raw_request_path(request.query.get("url"))
+            logger.info("Got file: {}".format(url))
+            return await send_cached(
+                request, url, path, fit=bool(request.query.get("fit"))
+            )
+
+        app.middlewares.append(bad_request)
+        app.router.add_get(route + "/cache/stats", pixiv_cache_stats_api)
+        app.router.add_get(route + "/ugoira/video", pixiv_ugoira_api)
+        app.router.add_get(route + "/ugoira/status", pixiv_ugoira_status_api)
+        app.router.add_get(route + "/id", pixiv_id_api)
+        app.router.add_get(route + "/raw", pixiv_raw_api)
@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Any, Callable
+
+
+class DiskCache:
+    """Size-bounded LRU bookkeeping for the pixiv-cache directory
+
+    Files are stored by the callers, this class only tracks them (relative to
+    `path`) and evicts the least recently served ones in a background thread
+    once `max_size` (in bytes) is exceeded. Top-level files and directories in
+    `exclude` are never tracked nor evicted.
+
+    Cached files never change, so an HTTP validator (ETag) is computed once
+    per file and stored along with it.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int | None = None,
+        exclude: set[str] | None = None,
+        interval: float = 60,
+    ):
+        # Absolute, so that files found by the scan and absolute paths given by
+        # callers are keyed the same as relative ones.
+        self._path = Path(path).resolve()
+        self._max_size = max_size
+        self._exclude = exclude or set()
+        self._interval = interval
+        self._logger = logging.getLogger("ayayaxyz.api.pixiv.cache")
+        self._lock = Lock()
+        # Relative path -> size, least recently served first.
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._validators: dict[str, str] = {}
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._evicted_bytes = 0
+        self._scan()
+        self._wakeup = Event()
+        self._thread = Thread(target=self._evict_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _key(self, path: Path | str) -> str:
+        path = Path(path)
+        if path.is_absolute():
+            path = path.relative_to(self._path)
+        return path.as_posix()
+
+    def _tracked(self, path: Path) -> bool:
+        parts = path.relative_to(self._path).parts
+        return len(parts) > 1 and parts[0] not in self._exclude
+
+    @staticmethod
+    def _validator(stat: os.stat_result) -> str:
+        # Same format as aiohttp's FileResponse, so both agree on the ETag.
+        return "{:x}-{:x}".format(stat.st_mtime_ns, stat.st_size)
+
+    def _scan(self):
+        files = []
+        for file in self._path.rglob("*"):
+            if not file.is_file() or not self._tracked(file):
+                continue
+            stat = file.stat()
+            key = file.relative_to(self._path).as_posix()
+            files.append((stat.st_atime, key, stat))
+        files.sort(key=lambda x: x[0])
+        for _, key, stat in files:
+            self._entries[key] = stat.st_size
+            self._validators[key] = self._validator(stat)
+            self._bytes += stat.st_size
+        self._logger.info(
+            "Tracking {} cached files ({} bytes)".format(len(self._entries), self._bytes)
+        )
+
+    def lookup(self, path: Path | str) -> bool:
+        """Returns whether `path` is cached, marking it as recently served."""
+        key = self._key(path)
+        file = self._path.joinpath(key)
+        with self._lock:
+            if key in self._entries and file.is_file():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                hit = True
+            else:
+                if key in self._entries:
+                    # Deleted behind our back.
+                    self._bytes -= self._entries.pop(key)
+                    self._validators.pop(key, None)
+                self._misses += 1
+                hit = False
+        if hit:
+            # Persist the access order across restarts, mtime is left alone
+            # (to the nanosecond, it's part of the validator).
+            try:
+                os.utime(file, ns=(time.time_ns(), file.stat().st_mtime_ns))
+            except OSError:
+                pass
+        return hit
+
+    def add(self, path: Path | str):
+        """Registers a file which has just been written to the cache."""
+        key = self._key(path)
+        try:
+            stat = self._path.joinpath(key).stat()
+        except OSError:
+            return
+        size = stat.st_size
+        with self._lock:
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._validators[key] = self._validator(stat)
+            over_budget = self._max_size is not None and self._bytes > self._max_size
+        if over_budget:
+            self._wakeup.set()
+
+    def validator(self, path: Path | str) -> str | None:
+        """Returns the ETag of a cached file, without quotes"""
+        with self._lock:
+            return self._validators.get(self._key(path))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "files": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "evicted_bytes": self._evicted_bytes,
+            }
+
+    def evict(self):
+        if self._max_size is None:
+            return
+        while True:
+            with self._lock:
+                if self._bytes <= self._max_size or not self._entries:
+                    return
+                key, size = self._entries.popitem(last=False)
+                self._validators.pop(key, None)
+                self._bytes -= size
+            try:
+                self._path.joinpath(key).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._logger.warning("Failed to evict {}: {}".format(key, e))
+                continue
+            self._logger.debug("Evicted {} ({} bytes)".format(key, size))
+            with self._lock:
+                self._evictions += 1
+                self._evicted_bytes += size
+
+    def _evict_loop(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            self.evict()
+
+
+class MemoryCache:
+    """Thread-safe in-memory LRU cache with a TTL and an approximate memory bound
+
+    The size of an entry is estimated from its JSON representation, unless
+    `sizeof` is specified.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float,
+        sizeof: Callable[[Any], int] | None = None,
+    ):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        if sizeof is not None:
+            self._sizeof = sizeof
+        self._lock = Lock()
+        # Key -> (expiry, size, value), least recently used first.
+        self._entries: OrderedDict[Any, tuple[float, int, Any]] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _sizeof(value: Any) -> int:
+        try:
+            return len(json.dumps(value, ensure_ascii=False, default=str))
+        except (TypeError, ValueError):
+            return sys.getsizeof(value)
+
+    def get(self, key: Any) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._bytes -= self._entries.pop(key)[1]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, key: Any, value: Any):
+        size = self._sizeof(value)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (time.monotonic() + self._ttl, size, value)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, size, _) = self._entries.popitem(last=False)
+                self._bytes -= size
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+            }
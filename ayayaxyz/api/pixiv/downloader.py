@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from threading import Lock, Thread
+from typing import IO, AsyncIterator
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .exceptions import DownloadError
+from .ratelimit import RateLimiter
+from ...metrics import REGISTRY
+
+DOWNLOAD_BYTES = REGISTRY.counter(
+    "ayayaxyz_pixiv_download_bytes_total",
+    "Bytes downloaded from Pixiv",
+    labels=("host",),
+)
+
+
+class Downloader:
+    """Asyncio-native image downloader with a pooled keep-alive session
+
+    The session lives on the loop passed to `attach` (the bot's one), callers
+    running in that loop use it directly. Callers from other loops (each Flask
+    request runs in its own event loop, so do the ugoira jobs) are bridged to
+    it, so everyone shares the same connection pool. Without an attached loop
+    (e.g. in scripts), a loop thread of our own is started on first use.
+    Requests go through `limiter` (if any), picking the bucket by host.
+    """
+
+    def __init__(
+        self,
+        limit_per_host: int = 8,
+        limit: int = 64,
+        keepalive_timeout: float = 60,
+        referer: str = "https://app-api.pixiv.net/",
+        limiter: RateLimiter | None = None,
+    ):
+        self._limiter = limiter
+        self._limit_per_host = limit_per_host
+        self._limit = limit
+        self._keepalive_timeout = keepalive_timeout
+        self._referer = referer
+        self._logger = logging.getLogger("ayayaxyz.api.pixiv.downloader")
+        self._session: aiohttp.ClientSession | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._own_loop = False
+        self._loop_lock = Lock()
+
+    def attach(self, loop: asyncio.AbstractEventLoop | None = None):
+        """Runs the session on `loop` (the running one by default) from now on"""
+        loop = loop or asyncio.get_running_loop()
+        with self._loop_lock:
+            previous, self._loop = self._loop, loop
+            own, self._own_loop = self._own_loop, False
+            session, self._session = self._session, None
+        if previous is None or previous is loop:
+            self._session = session
+            return
+
+        async def retire():
+            if session is not None:
+                await session.close()
+            if own:
+                previous.stop()
+
+        asyncio.run_coroutine_threadsafe(retire(), previous)
+
+    def _home(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._own_loop = True
+                thread = Thread(target=self._loop.run_forever)
+                thread.daemon = True
+                thread.start()
+            return self._loop
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if (
+            self._session is None
+            or self._session.closed
+            or self._loop is not asyncio.get_running_loop()
+        ):
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Referer": self._referer},
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=60),
+            )
+        return self._session
+
+    async def _run(self, coro):
+        """Runs `coro` on the session's loop and waits for it from ours"""
+        loop = self._home()
+        if loop is asyncio.get_running_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    async def _request(self, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """Sends a GET request once the rate limiter allows it"""
+        if self._limiter is None:
+            return await self._get_session().get(url, **kwargs)
+        bucket = self._limiter.for_host(urlparse(url).hostname)
+        await bucket.acquire()
+        rsp = await self._get_session().get(url, **kwargs)
+        self._limiter.report(bucket, rsp.status, rsp.headers.get("Retry-After"))
+        return rsp
+
+    async def _download(self, url: str, file: IO[bytes]) -> int:
+        host = urlparse(url).hostname
+        written = 0
+        try:
+            async with await self._request(url) as rsp:
+                if rsp.status != 200:
+                    raise DownloadError(
+                        "Failed to download {} (status code {})".format(url, rsp.status)
+                    )
+                async for chunk in rsp.content.iter_chunked(64 * 1024):
+                    file.write(chunk)
+                    written += len(chunk)
+                    # Counted as received, failed downloads used bandwidth too.
+                    DOWNLOAD_BYTES.inc(len(chunk), host=host)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DownloadError("Failed to download {}: {}".format(url, e))
+        self._logger.debug("Downloaded {} ({} bytes)".format(url, written))
+        return written
+
+    async def download(self, url: str, file: IO[bytes]) -> int:
+        """Downloads `url` into a writable binary file object
+
+        Returns the number of bytes written.
+        """
+        return await self._run(self._download(url, file))
+
+    async def _get(self, url: str, raise_for_status: bool = True, **kwargs) -> bytes:
+        try:
+            async with await self._request(url, **kwargs) as rsp:
+                if raise_for_status:
+                    rsp.raise_for_status()
+                body = await rsp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DownloadError("Failed to fetch {}: {}".format(url, e))
+        DOWNLOAD_BYTES.inc(len(body), host=urlparse(url).hostname)
+        return body
+
+    async def get(self, url: str, raise_for_status: bool = True, **kwargs) -> bytes:
+        """Sends a GET request through the shared pool and returns the body
+
+        Error responses raise DownloadError unless `raise_for_status` is False.
+        """
+        return await self._run(self._get(url, raise_for_status, **kwargs))
+
+    async def _open(self, url: str) -> aiohttp.ClientResponse:
+        try:
+            rsp = await self._request(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DownloadError("Failed to download {}: {}".format(url, e))
+        if rsp.status != 200:
+            rsp.release()
+            raise DownloadError(
+                "Failed to download {} (status code {})".format(url, rsp.status)
+            )
+        return rsp
+
+    async def stream(
+        self, url: str, chunk_size: int = 64 * 1024
+    ) -> tuple[dict[str, str], AsyncIterator[bytes]]:
+        """Starts downloading `url`, returns its headers and an iterator over its body
+
+        The body has to be consumed (or the iterator closed) to free the
+        connection.
+        """
+        rsp = await self._run(self._open(url))
+        loop = self._home()
+
+        async def body():
+            try:
+                while True:
+                    try:
+                        chunk = await self._run(rsp.content.read(chunk_size))
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        raise DownloadError("Failed to download {}: {}".format(url, e))
+                    if not chunk:
+                        return
+                    DOWNLOAD_BYTES.inc(len(chunk), host=urlparse(url).hostname)
+                    yield chunk
+            finally:
+                loop.call_soon_threadsafe(rsp.release)
+
+        return dict(rsp.headers), body()
+
+    async def close(self):
+        if self._session is not None:
+            await self._run(self._session.close())
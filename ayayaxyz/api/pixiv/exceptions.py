@@ -44,3 +44,11 @@ class NotAnUgoiraError(GetUgoiraError):
     """The illust trying to get is not an ugoira"""
 
     pass
+
+
+class BadRequestError(PixivException):
+    """A web API request is invalid, `status` is the HTTP status to reply with"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Any, Awaitable, Callable
+
+
+class Job:
+    """A conversion job, `status` is one of queued, running, done or failed"""
+
+    def __init__(self, key: Any):
+        self.key = key
+        self.status = "queued"
+        self.result: Path | None = None
+        self.error: str | None = None
+        self.created = time.time()
+        self.started: float | None = None
+        self.finished: float | None = None
+        self.future: Future = Future()
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """Runs jobs with a bounded number of workers, merging duplicate jobs
+
+    Jobs run on a dedicated event loop thread, so they outlive the (Flask)
+    request which submitted them. Finished jobs are forgotten after `keep`
+    seconds, failed ones (or done ones whose file is gone, e.g. evicted from
+    the cache) can be resubmitted right away.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[Any], Awaitable[Path]],
+        max_workers: int = 2,
+        keep: float = 3600,
+    ):
+        self._run_job = run
+        self._keep = keep
+        self._logger = logging.getLogger("ayayaxyz.api.pixiv.jobs")
+        self._lock = Lock()
+        self._jobs: dict[Any, Job] = {}
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._thread = Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _prune(self):
+        now = time.time()
+        for key, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self._keep:
+                del self._jobs[key]
+
+    @staticmethod
+    def _gone(job: Job) -> bool:
+        """Whether the file of a done job has been deleted since"""
+        return isinstance(job.result, Path) and not job.result.exists()
+
+    def submit(self, key: Any) -> Job:
+        """Returns the job for `key`, queueing a new one if needed"""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(key)
+            if job is not None and job.status != "failed" and not self._gone(job):
+                return job
+            job = Job(key)
+            self._jobs[key] = job
+        self._logger.debug("Queued job {}".format(key))
+        asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+        return job
+
+    def get(self, key: Any) -> Job | None:
+        with self._lock:
+            return self._jobs.get(key)
+
+    async def _run(self, job: Job):
+        async with self._semaphore:
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = await self._run_job(job.key)
+            except Exception as e:
+                self._logger.warning("Job {} failed: {}".format(job.key, e))
+                job.error = str(e)
+                job.status = "failed"
+                job.future.set_exception(e)
+            else:
+                job.status = "done"
+                job.future.set_result(job.result)
+            finally:
+                job.finished = time.time()
+
+    @staticmethod
+    async def wait(job: Job, timeout: float | None = None) -> Path | None:
+        """Waits for the job result, returns None if it isn't done in time"""
+        # Not `asyncio.wrap_future`: cancelling it on timeout would cancel the
+        # job itself, and its callback would outlive the (Flask) waiting loop.
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+
+        def wake():
+            if not waiter.done():
+                waiter.set_result(None)
+
+        def on_done(_: Future):
+            try:
+                loop.call_soon_threadsafe(wake)
+            except RuntimeError:
+                # The waiting loop timed out and is closed already.
+                pass
+
+        job.future.add_done_callback(on_done)
+        done, _ = await asyncio.wait({waiter}, timeout=timeout)
+        if not done:
+            waiter.cancel()
+            return None
+        return job.future.result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            status: statuses.count(status)
+            for status in ("queued", "running", "done", "failed")
+        }
@@ -0,0 +1,81 @@
+from random import randrange, shuffle
+
+from .exceptions import SearchError
+
+
+class TagMatcher:
+    """Precompiled keyword matcher for illusts
+
+    + `tags`: keywords which must all be found in the illust tags
+    + `exclude_tags`: keywords prefixed with "-", the illust must not contain any
+
+    A keyword is found if all of its words are in a tag name (or its
+    translated name), or if the tag is the keyword with its words joined
+    (both orders for two-word keywords, e.g. "hu tao" matches "taohu").
+    R-18 illusts only match if "R-18" is one of the keywords, and vice versa.
+    """
+
+    def __init__(
+        self,
+        tags: list[str] | set[str],
+        exclude_tags: list[str] | set[str] | None = None,
+    ):
+        self.tags = set(x.lower() for x in tags)
+        self.exclude_tags = set(x.lower()[1:] for x in exclude_tags or ())
+        self._r18 = "r-18" in self.tags
+        self._keywords: list[tuple[frozenset[str], frozenset[str]]] = []
+        for kw in self.tags:
+            kw_list = kw.split(" ")
+            joined = {"".join(kw_list)}
+            if len(kw_list) == 2:
+                joined.add(kw_list[1] + kw_list[0])
+            self._keywords.append((frozenset(kw_list), frozenset(joined)))
+        self._exclude_keywords = [frozenset(kw.split(" ")) for kw in self.exclude_tags]
+
+    @staticmethod
+    def _normalise(illust: dict) -> tuple[bool, list[frozenset[str]], set[str]]:
+        """Returns (is R-18, word sets of every name, lowercased names)"""
+        r18 = False
+        words = []
+        names = set()
+        for tag in illust["tags"]:
+            if tag["name"] == "R-18":
+                r18 = True
+            for name in (tag["name"], tag["translated_name"]):
+                if name is None:
+                    continue
+                name = name.lower()
+                names.add(name)
+                words.append(frozenset(name.split(" ")))
+        return r18, words, names
+
+    def matches(self, illust: dict) -> bool:
+        r18, words, names = self._normalise(illust)
+        if r18 != self._r18:
+            return False
+        for kw_words in self._exclude_keywords:
+            if any(kw_words <= tag_words for tag_words in words):
+                return False
+        for kw_words, kw_joined in self._keywords:
+            if kw_joined.isdisjoint(names) and not any(
+                kw_words <= tag_words for tag_words in words
+            ):
+                return False
+        return True
+
+    def select(self, illusts: list[dict]) -> dict:
+        """Returns a random illust matching the keywords"""
+        # Lazy Fisher-Yates shuffle, so we stop as soon as an illust matches.
+        order = list(range(len(illusts)))
+        for i in range(len(order)):
+            j = randrange(i, len(order))
+            order[i], order[j] = order[j], order[i]
+            if self.matches(illusts[order[i]]):
+                return illusts[order[i]]
+        raise SearchError("Couldn't find any images matching provided keywords")
+
+    def filter(self, illusts: list[dict]) -> list[dict]:
+        """Returns every illust matching the keywords, in a random order"""
+        matches = [illust for illust in illusts if self.matches(illust)]
+        shuffle(matches)
+        return matches
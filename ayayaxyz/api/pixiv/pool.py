@@ -0,0 +1,54 @@
+import asyncio
+
+from .matcher import TagMatcher
+
+
+class SearchPool:
+    """Unused search results for a query, so the next result can be served
+    without searching Pixiv again
+
+    + `ready`: illusts which can be served as-is
+    + `seeds`: search results matching the query which haven't been expanded
+      through a related lookup yet (served as-is when related is disabled)
+    + `next_url`: the next search page, fetched when the pool runs low
+    """
+
+    def __init__(self, word: str, matcher: TagMatcher, sort: str, related: bool):
+        self.word = word
+        self.matcher = matcher
+        self.sort = sort
+        self.related = related
+        self.ready: list[dict] = []
+        self.seeds: list[dict] = []
+        self.next_url: str | None = None
+        self.started = False
+        self.seen: set[int] = set()
+        self.lock = asyncio.Lock()
+
+    def add_ready(self, illusts: list[dict]) -> int:
+        return self._add(self.ready, illusts)
+
+    def add_seeds(self, illusts: list[dict]) -> int:
+        return self._add(self.seeds, illusts)
+
+    def _add(self, target: list[dict], illusts: list[dict]) -> int:
+        added = 0
+        for illust in self.matcher.filter(illusts):
+            if illust["id"] in self.seen:
+                continue
+            self.seen.add(illust["id"])
+            target.append(illust)
+            added += 1
+        return added
+
+    @property
+    def exhausted(self) -> bool:
+        return self.started and self.next_url is None and not self.ready and not self.seeds
+
+    def reset(self):
+        """Starts over from the first page, allowing repeated results"""
+        self.ready.clear()
+        self.seeds.clear()
+        self.seen.clear()
+        self.next_url = None
+        self.started = False
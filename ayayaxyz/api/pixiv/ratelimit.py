@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from threading import Lock
+
+_logger = logging.getLogger("ayayaxyz.api.pixiv.ratelimit")
+
+
+class TokenBucket:
+    """Thread-safe token bucket with an adaptive (AIMD) rate
+
+    Tokens are reserved under a lock and waited for with `asyncio.sleep`, so a
+    bucket can be shared by every event loop (bot, Flask requests, downloader).
+    The rate is halved (down to `min_rate`) whenever upstream throttles us,
+    and every request is paused for the backoff delay. It then grows back by
+    `increase` requests/s per successful request, up to `max_rate`.
+
+    + `rate`: sustained requests per second
+    + `burst`: requests which can be sent at once after being idle
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        min_rate: float | None = None,
+        increase: float | None = None,
+        backoff: float = 5,
+    ):
+        self.name = name
+        self._max_rate = rate
+        self._min_rate = min_rate if min_rate is not None else rate / 16
+        self._increase = increase if increase is not None else rate / 100
+        self._backoff = backoff
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        # Tokens are counted from here, in the future while backing off.
+        self._updated = time.monotonic()
+        self._lock = Lock()
+        self._requests = 0
+        self._throttled = 0
+        self._waits = 0
+        self._wait_total = 0.0
+
+    def _refill(self, now: float):
+        if now <= self._updated:
+            return
+        self._tokens = min(
+            self._burst, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Takes a token, returns how long to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            self._requests += 1
+            wait = max(0.0, self._updated - now - min(0.0, self._tokens) / self._rate)
+            if wait > 0:
+                self._waits += 1
+                self._wait_total += wait
+            return wait
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._increase)
+
+    def throttled(self, retry_after: float | None = None):
+        """Backs off after a 429/403 (or a rate limit error) from upstream"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._rate = max(self._min_rate, self._rate / 2)
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, now + (retry_after or self._backoff))
+            self._throttled += 1
+            rate = self._rate
+        _logger.warning(
+            "Throttled by Pixiv ({}), slowing down to {:.2f} requests/s".format(
+                self.name, rate
+            )
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate": self._rate,
+                "max_rate": self._max_rate,
+                "tokens": self._tokens,
+                "paused_for": max(0.0, self._updated - time.monotonic()),
+                "requests": self._requests,
+                "throttled": self._throttled,
+                "waits": self._waits,
+                "wait_total": self._wait_total,
+            }
+
+
+class RateLimiter:
+    """Token buckets for each kind of Pixiv traffic
+
+    + `app`: App API (search, related, illust details...)
+    + `ajax`: www.pixiv.net (tag suggestions, ugoira metadata...)
+    + `image`: i.pximg.net (images and ugoira ZIPs)
+    """
+
+    def __init__(
+        self, app_rate: float = 4, ajax_rate: float = 8, image_rate: float = 32
+    ):
+        self.app = TokenBucket("app", rate=app_rate, burst=app_rate * 2)
+        self.ajax = TokenBucket("ajax", rate=ajax_rate, burst=ajax_rate * 2)
+        self.image = TokenBucket("image", rate=image_rate, burst=image_rate * 2)
+
+    def for_host(self, host: str | None) -> TokenBucket:
+        if host is not None and host.endswith("pximg.net"):
+            return self.image
+        return self.ajax
+
+    def report(self, bucket: TokenBucket, status: int, retry_after: str | None = None):
+        """Feeds an upstream response status back to its bucket"""
+        if status in (403, 429):
+            try:
+                delay = float(retry_after) if retry_after else None
+            except ValueError:
+                delay = None
+            bucket.throttled(delay)
+        elif status < 400:
+            bucket.success()
+
+    def stats(self) -> dict:
+        return {
+            bucket.name: bucket.stats() for bucket in (self.app, self.ajax, self.image)
+        }
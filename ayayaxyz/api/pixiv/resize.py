@@ -0,0 +1,55 @@
+from io import BytesIO
+
+from PIL import Image
+
+# Telegram photo limits: 10 MB, width + height of at most 10000 pixels.
+PHOTO_MAX_BYTES = 10 * 1000 * 1000
+PHOTO_MAX_DIMENSIONS = 10000
+QUALITIES = (92, 85, 75, 60)
+# Raised for images which can't be decoded, including those over Pillow's
+# decompression bomb limit (Image.MAX_IMAGE_PIXELS), which are never decoded.
+UNREADABLE = (OSError, Image.DecompressionBombError, Image.DecompressionBombWarning)
+
+
+def fits(
+    data: bytes,
+    max_bytes: int = PHOTO_MAX_BYTES,
+    max_dimensions: int = PHOTO_MAX_DIMENSIONS,
+) -> bool:
+    """Returns whether the image can be sent as is, only its header is decoded"""
+    if len(data) > max_bytes:
+        return False
+    with Image.open(BytesIO(data)) as image:
+        return sum(image.size) <= max_dimensions
+
+
+def fit_photo(
+    data: bytes,
+    max_bytes: int = PHOTO_MAX_BYTES,
+    max_dimensions: int = PHOTO_MAX_DIMENSIONS,
+    qualities: tuple[int, ...] = QUALITIES,
+) -> bytes:
+    """Downscales and re-encodes an image to JPEG so it fits the limits
+
+    Every quality of the ladder is tried before scaling the image down further,
+    so the result is as large and as good as the limits allow. This is CPU
+    bound, run it in a process pool.
+    """
+    with Image.open(BytesIO(data)) as image:
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+    scale = min(1, max_dimensions / sum(image.size))
+    while True:
+        size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        resized = image.resize(size, Image.LANCZOS) if size != image.size else image
+        for quality in qualities:
+            output = BytesIO()
+            resized.save(output, "JPEG", quality=quality, optimize=True)
+            if output.tell() <= max_bytes:
+                return output.getvalue()
+        scale *= 0.75
@@ -0,0 +1,86 @@
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+
+
+class TagStore:
+    """Persistent English -> Japanese tag translation dictionary
+
+    Successful translations are kept forever, failed ones are remembered for
+    `negative_ttl` seconds. A failure is recorded along with the method that
+    failed (`"cps"` for the Ajax API only, `"legacy"` when the search fallback
+    failed too), so a lookup without fallback can't hide a fallback lookup.
+    """
+
+    def __init__(self, path: Path, negative_ttl: float = 86400):
+        self._negative_ttl = negative_ttl
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS translations (
+                tag TEXT PRIMARY KEY,
+                name TEXT,
+                source TEXT NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        self._db.commit()
+
+    def get(self, tag: str, fallback: bool = True) -> tuple[bool, str | None]:
+        """Returns (known, translated name), name is None for a known failure"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT name, source, updated FROM translations WHERE tag = ?",
+                (tag.lower(),),
+            ).fetchone()
+        if row is None:
+            return False, None
+        name, source, updated = row
+        if name is not None:
+            return True, name
+        if time.time() - updated > self._negative_ttl:
+            return False, None
+        if fallback and source != "legacy":
+            return False, None
+        return True, None
+
+    def put(self, tag: str, name: str | None, source: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                (tag.lower(), name, source, time.time()),
+            )
+            self._db.commit()
+
+    def learn(self, illusts: list[dict]):
+        """Remembers the translations Pixiv attached to the illusts' tags"""
+        rows = {}
+        for illust in illusts:
+            for tag in illust["tags"]:
+                if tag["translated_name"]:
+                    rows[tag["translated_name"].lower()] = tag["name"]
+        if not rows:
+            return
+        now = time.time()
+        with self._lock:
+            # Never override an existing mapping, only failures.
+            self._db.executemany(
+                """INSERT INTO translations VALUES (?, ?, 'illust', ?)
+                ON CONFLICT(tag) DO UPDATE SET
+                    name = excluded.name,
+                    source = excluded.source,
+                    updated = excluded.updated
+                WHERE translations.name IS NULL""",
+                [(tag, name, now) for tag, name in rows.items()],
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            known, failed = self._db.execute(
+                "SELECT COUNT(name), COUNT(*) - COUNT(name) FROM translations"
+            ).fetchone()
+        return {"translations": known, "failures": failed}
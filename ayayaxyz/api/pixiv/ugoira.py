@@ -0,0 +1,132 @@
+import asyncio
+from pathlib import Path
+from typing import IO, NamedTuple
+from zipfile import ZipFile
+
+
+class EncoderProfile(NamedTuple):
+    """ffmpeg output settings for ugoira videos
+
+    + `extension`: output file extension
+    + `format`: ffmpeg muxer
+    + `args`: encoder arguments
+    + `filter`: video filter applied after the frame timing one, if any
+    """
+
+    extension: str
+    format: str
+    args: list[str]
+    filter: str | None = None
+
+
+PROFILES: dict[str, EncoderProfile] = {
+    # VP9 tuned for speed: realtime deadline and row based multithreading.
+    "webm": EncoderProfile(
+        "webm",
+        "webm",
+        [
+            "-c:v", "libvpx-vp9",
+            "-deadline", "realtime",
+            "-cpu-used", "8",
+            "-row-mt", "1",
+            "-crf", "32",
+            "-b:v", "0",
+            "-pix_fmt", "yuv420p",
+        ],
+    ),
+    # libvpx-vp9 default settings (smallest output, slowest encode).
+    "webm-best": EncoderProfile(
+        "webm", "webm", ["-c:v", "libvpx-vp9", "-pix_fmt", "yuv420p"]
+    ),
+    # H.264 is played natively as an animation by Telegram.
+    "mp4": EncoderProfile(
+        "mp4",
+        "mp4",
+        [
+            "-c:v", "libx264",
+            "-preset", "ultrafast",
+            "-crf", "23",
+            "-pix_fmt", "yuv420p",
+            "-movflags", "+faststart",
+        ],
+        # yuv420p needs even dimensions.
+        "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+    ),
+    "gif": EncoderProfile(
+        "gif",
+        "gif",
+        ["-loop", "0"],
+        "split[a][b];[a]palettegen[p];[b][p]paletteuse",
+    ),
+    "apng": EncoderProfile("png", "apng", ["-c:v", "apng", "-plays", "0"]),
+}
+
+
+def setpts_filter(frames: list[dict]) -> str:
+    """Builds a setpts filter giving each piped frame its own delay"""
+    terms = []
+    timestamp = 0
+    for index, frame in enumerate(frames):
+        terms.append("eq(N,{})*{}".format(index, timestamp))
+        timestamp += frame["delay"]
+    # The last frame is piped twice so its delay is applied.
+    terms.append("eq(N,{})*{}".format(len(frames), timestamp))
+    return "setpts='round(({})/1000/TB)'".format("+".join(terms))
+
+
+def output_args(profile: EncoderProfile, out: Path, filters: list[str]) -> list[str]:
+    if profile.filter:
+        filters = filters + [profile.filter]
+    args = []
+    if filters:
+        args += ["-vf", ",".join(filters)]
+    return args + profile.args + ["-vsync", "vfr", "-f", profile.format, f"{out}"]
+
+
+async def encode_zip(
+    archive: str | Path | IO[bytes],
+    frames: list[dict],
+    out: Path,
+    profile: EncoderProfile,
+    quiet: bool = False,
+) -> Path:
+    """Encodes an ugoira by piping the frames straight from its ZIP
+
+    The output is written to a temporary file, renamed to `out` on success.
+    """
+    part = out.with_name(out.name + ".part")
+    args = [
+        "ffmpeg",
+        "-y",
+        "-f",
+        "image2pipe",
+        # Millisecond time base, frame timestamps are set by setpts.
+        "-framerate",
+        "1000",
+        "-i",
+        "pipe:0",
+    ] + output_args(profile, part, [setpts_filter(frames)])
+    output = asyncio.subprocess.DEVNULL if quiet else None
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdin=asyncio.subprocess.PIPE, stdout=output, stderr=output
+    )
+    try:
+        with ZipFile(archive, "r") as f:
+            for frame in frames + frames[-1:]:
+                proc.stdin.write(f.read(frame["file"]))
+                await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    except Exception:
+        proc.kill()
+        await proc.wait()
+        part.unlink(missing_ok=True)
+        raise
+    finally:
+        proc.stdin.close()
+    retcode = await proc.wait()
+    if retcode != 0:
+        part.unlink(missing_ok=True)
+        raise RuntimeError("Convert error")
+    part.replace(out)
+    return out
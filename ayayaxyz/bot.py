@@ -1,10 +1,14 @@
 from io import BytesIO
+import asyncio
 import os
 import logging
+import uuid
+from pathlib import Path
 
 import telegram
 
 import ayayaxyz.helper as helper
+import ayayaxyz.metrics as metrics
 from copy import copy
 from telegram import Update, InputMediaPhoto, InlineKeyboardMarkup
 from telegram.ext import (
@@ -14,15 +18,20 @@ from telegram.ext import (
     CommandHandler,
     CallbackContext,
 )
-from telegram.error import TelegramError
+from telegram.error import BadRequest, TelegramError
 from ayayaxyz.api.pixiv import (
     Pixiv,
     DownloadError,
     SearchError,
     LoginError,
 )
+from ayayaxyz.file_ids import FileId, FileIdStore
+from ayayaxyz.prefetch import Prefetcher
+from ayayaxyz.scheduler import ChatScheduler
 from saucerer import Saucerer
 from saucerer.exceptions import SaucererError
+from aiohttp import web
+from appdirs import user_cache_dir
 from flask import Flask
 from waitress import serve
 from threading import Thread
@@ -32,9 +41,70 @@ _logger = logging.getLogger("ayayaxyz")
 
 app = Flask(__name__)
 # app.use_x_sendfile = True
-pixiv = Pixiv()
+_cache_max_size = os.getenv("PIXIV_CACHE_MAX_SIZE")
+pixiv = Pixiv(
+    cache_max_size=int(_cache_max_size) * 1024 * 1024 if _cache_max_size else None,
+    stream_through=os.getenv("PIXIV_STREAM_THROUGH", "").lower() in ("1", "true"),
+    download_limit_per_host=int(os.getenv("PIXIV_DOWNLOAD_CONCURRENCY", 8)),
+    ugoira_workers=int(os.getenv("PIXIV_UGOIRA_WORKERS", 2)),
+    ugoira_profile=os.getenv("PIXIV_UGOIRA_FORMAT", "webm"),
+    resize_workers=int(os.getenv("PIXIV_RESIZE_WORKERS", 2)),
+    app_api_rate=float(os.getenv("PIXIV_APP_API_RATE", 4)),
+    ajax_rate=float(os.getenv("PIXIV_AJAX_RATE", 8)),
+    image_rate=float(os.getenv("PIXIV_IMAGE_RATE", 32)),
+)
 saucerer = Saucerer()
 web_url = os.getenv("WEB_URL", "http://127.0.0.1:8080")
+# "flask" runs waitress in a thread, "aiohttp" serves from the bot's event loop.
+web_server = os.getenv("WEB_SERVER", "flask").lower()
+web_app = web.Application() if web_server == "aiohttp" else None
+
+
+def _prefetch_size(result) -> int:
+    """Bytes held by a prefetched (illust, photos), see `_pixiv_fetch_photos`"""
+    if not result:
+        return 0
+    return sum(
+        photo.getbuffer().nbytes
+        for photo, _, _ in result[1]
+        if isinstance(photo, BytesIO)
+    )
+
+
+prefetcher = (
+    Prefetcher(
+        max_bytes=int(os.getenv("PIXIV_PREFETCH_MAX_SIZE", 64)) * 1024 * 1024,
+        sizeof=_prefetch_size,
+    )
+    if os.getenv("PIXIV_PREFETCH", "").lower() in ("1", "true")
+    else None
+)
+_file_id_store = os.getenv("TELEGRAM_FILE_ID_STORE")
+if _file_id_store:
+    _file_id_store = Path(_file_id_store)
+else:
+    _file_id_store = Path(user_cache_dir("ayayaxyz-telegram", "tretrauit"))
+    _file_id_store.mkdir(parents=True, exist_ok=True)
+    _file_id_store = _file_id_store.joinpath("file_ids.sqlite")
+file_ids = FileIdStore(_file_id_store)
+# Updates handled at the same time, updates from a chat are always handled in order.
+update_workers = int(os.getenv("UPDATE_WORKERS", 1))
+scheduler = ChatScheduler(max_workers=update_workers)
+
+
+def bot_stats() -> dict:
+    return {
+        "updates": scheduler.stats(),
+        "callbacks": helper.callbacks.stats(),
+        "sends": helper.sender.stats(),
+        "file_ids": file_ids.stats(),
+    }
+
+
+metrics.REGISTRY.add_collector(lambda: metrics.stats_families("ayayaxyz", bot_stats()))
+metrics.REGISTRY.add_collector(
+    lambda: metrics.stats_families("ayayaxyz_pixiv", pixiv.cache_stats())
+)
 
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -47,6 +117,58 @@ def _pixiv_get_id(context: ContextTypes.DEFAULT_TYPE):
     return pixiv.get_id_from_str(context.args[0])
 
 
+async def _pixiv_fetch_photos(
+    illust, pictures: list[int], quick: bool, to_url: bool, reuse: bool = True
+) -> list[tuple]:
+    """Returns (photo, filename, source URL) for every page to send
+
+    If every page was already sent to Telegram, `photo` is its FileId and
+    nothing is downloaded. Otherwise it's a BytesIO (or the URL if `to_url`).
+    """
+    quality = "large" if quick else "original"
+    # Only resolves the URLs, nothing is downloaded yet.
+    sources = await pixiv.download_illust(
+        illust=illust, pictures=pictures, quality=quality, limit=9, to_url=True
+    )
+    if reuse:
+        ids = [file_ids.get(url) for url, _ in sources]
+        if all(ids):
+            return [(ids[i], name, url) for i, (url, name) in enumerate(sources)]
+    if to_url:
+        photos = sources
+    else:
+        photos = await pixiv.download_illust(
+            illust=illust, pictures=pictures, quality=quality, limit=9, fit=True
+        )
+    return [(photo[0], photo[1], url) for photo, (url, _) in zip(photos, sources)]
+
+
+async def _pixiv_send_photos(send, illusts: list[tuple], refetch):
+    """Sends the photos with `send(illusts)` and remembers their file IDs
+
+    If Telegram rejects the file IDs we had, they are forgotten and the photos
+    from `refetch()` are uploaded instead.
+    """
+    try:
+        result = await send(illusts)
+    except BadRequest as e:
+        if not isinstance(illusts[0][0], FileId):
+            raise
+        _logger.info("Stale file ID ({}), uploading the images again".format(e))
+        for x in illusts:
+            file_ids.forget(x[2])
+        try:
+            illusts = await refetch()
+        except DownloadError:
+            raise e
+        result = await send(illusts)
+    msgs = result if isinstance(result, (list, tuple)) else [result]
+    for x, msg in zip(illusts, msgs):
+        if msg.photo and not isinstance(x[0], FileId):
+            file_ids.put(x[2], msg.photo[-1].file_id)
+    return result
+
+
 async def _pixiv_dl_illust(
     quick: bool,
     illust,
@@ -54,12 +176,9 @@ async def _pixiv_dl_illust(
     message: telegram.Message,
     to_url: bool = False,
 ) -> list | dict:
-    quality = "original"
-    if quick:
-        quality = "large"
     try:
-        illusts = await pixiv.download_illust(
-            illust=illust, pictures=pictures, quality=quality, limit=9, to_url=to_url
+        illusts = await _pixiv_fetch_photos(
+            illust=illust, pictures=pictures, quick=quick, to_url=to_url
         )
     except DownloadError as e:
         msg_kwargs = {
@@ -71,9 +190,50 @@ async def _pixiv_dl_illust(
     return illusts
 
 
+async def _pixiv_resolve_dl_illust(
+    resolve, quick: bool, to_url: bool, resolved: list
+) -> tuple:
+    """Resolves an illust then downloads its first page, for prefetching"""
+    illust = await resolve()
+    resolved.append(illust)
+    illusts = await _pixiv_fetch_photos(
+        illust=illust, pictures=[0], quick=quick, to_url=to_url
+    )
+    return illust, illusts
+
+
+def _pixiv_prefetch(resolve, quick: bool, to_url: bool, unused=None) -> str | None:
+    """Prefetches the result of `resolve` (if enabled) and returns its key
+
+    `unused(illust)` is called with the resolved illust if it's never sent.
+    """
+    if prefetcher is None:
+        return None
+    key = str(uuid.uuid4())
+    resolved = []
+    prefetcher.schedule(
+        key,
+        lambda: _pixiv_resolve_dl_illust(
+            resolve, quick=quick, to_url=to_url, resolved=resolved
+        ),
+        on_discard=(
+            (lambda: [unused(illust) for illust in resolved]) if unused else None
+        ),
+    )
+    return key
+
+
+async def _pixiv_prefetched(key: str | None) -> tuple | None:
+    if prefetcher is None or key is None:
+        return None
+    return await prefetcher.take(key)
+
+
 def _pixiv_photo_from_str_or_bytes(illust_dls: list, fast: bool = False):
-    if fast:
-        photo = "{web}/pixiv/raw?url={url}".format(
+    if isinstance(illust_dls[0][0], FileId):
+        photo = illust_dls[0][0]
+    elif fast:
+        photo = "{web}/pixiv/raw?url={url}&fit=1".format(
             web=web_url,
             url=illust_dls[0][0],
         )
@@ -83,6 +243,32 @@ def _pixiv_photo_from_str_or_bytes(illust_dls: list, fast: bool = False):
     return photo
 
 
+def _pixiv_media_group(illust_dls: list, caption: str) -> list[InputMediaPhoto]:
+    media = []
+    for x in illust_dls:
+        if isinstance(x[0], FileId):
+            media.append(InputMediaPhoto(media=x[0], caption=caption))
+        elif isinstance(x[0], BytesIO):
+            media.append(
+                InputMediaPhoto(media=x[0].getvalue(), caption=caption, filename=x[1])
+            )
+        elif isinstance(x[0], str):
+            _logger.debug(x[0])
+            media_url = "{web}/pixiv/raw?url={url}&fit=1".format(
+                web=web_url,
+                url=x[0],
+            )
+            _logger.debug(media_url)
+            media.append(
+                InputMediaPhoto(
+                    media=media_url,
+                    caption=caption,
+                    filename=x[1],
+                )
+            )
+    return media
+
+
 async def pixiv_id_cmd(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -189,42 +375,40 @@ Fetching <code>{illust_id}</code>...{notice}""".format(
                 ],
                 application=context.application,
             )
-            photo = _pixiv_photo_from_str_or_bytes(illust_dls=illusts, fast=fast)
-            await message.reply_photo(
-                photo=photo,
-                filename=illusts[0][1],
-                caption=caption,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=dl_button),
-            )
+
+            async def send(illust_dls: list):
+                return await helper.send(
+                    message,
+                    lambda: message.reply_photo(
+                        photo=_pixiv_photo_from_str_or_bytes(illust_dls, fast=fast),
+                        filename=illust_dls[0][1],
+                        caption=caption,
+                        parse_mode="HTML",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=dl_button),
+                    ),
+                )
+
         else:
-            media = []
-            for x in illusts:
-                if isinstance(x[0], BytesIO):
-                    media.append(
-                        InputMediaPhoto(
-                            media=x[0].getvalue(), caption=caption, filename=x[1]
-                        )
-                    )
-                elif isinstance(x[0], str):
-                    _logger.debug(x[0])
-                    media_url = "{web}/pixiv/raw?url={url}".format(
-                        web=web_url,
-                        url=x[0],
-                    )
-                    _logger.debug(media_url)
-                    media.append(
-                        InputMediaPhoto(
-                            media=media_url,
-                            caption=caption,
-                            filename=x[1],
-                        )
-                    )
-            msgs = await message.reply_media_group(
-                media=media,
-            )
+
+            async def send(illust_dls: list):
+                return await helper.send(
+                    message,
+                    lambda: message.reply_media_group(
+                        media=_pixiv_media_group(illust_dls, caption=caption),
+                    ),
+                    cost=len(illust_dls),
+                )
+
+        msgs = await _pixiv_send_photos(
+            send,
+            illusts,
+            refetch=lambda: _pixiv_fetch_photos(
+                illust, pictures=pictures, quick=quick, to_url=to_url, reuse=False
+            ),
+        )
+        if len(illusts) > 1:
             await helper.reply_html(msgs[-1], text=caption)
-        await notice_msg.delete()
+        await helper.delete(notice_msg)
     except TelegramError as e:
         msg_kwargs = {
             "message": notice_msg,
@@ -238,6 +422,13 @@ Fetching <code>{illust_id}</code>...{notice}""".format(
         _logger.warning("Error while sending message: {}".format(e))
 
 
+@helper.named_callback("pixiv-pages")
+async def pixiv_pages_cb(update: Update, context: CallbackContext, illust_id: str):
+    """"All pages" button, sends every page of the illust"""
+    context.args = [illust_id]
+    return await pixiv_id_cmd(update, context, fast=True)
+
+
 async def pixiv_related_cmd(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -248,6 +439,7 @@ async def pixiv_related_cmd(
     no_related: bool = False,
     translate_tags: bool = True,
     fast: bool = False,
+    prefetch_key: str | None = None,
 ):
     message = update.effective_message
     get_id = _pixiv_get_id(context=context)
@@ -303,22 +495,29 @@ async def pixiv_related_cmd(
         ),
         silent=True,
     )
-    try:
-        illust = await pixiv.related_illust(illust_id, tags=tags, recurse=3)
-    except SearchError as e:
-        await helper.edit_error(
-            message=notice_msg,
-            text="Failed to search for related image: <code>{}</code>".format(e),
-        )
-        _logger.warning("Error while searching for related image: {}".format(e))
-        return
+    prefetched = await _pixiv_prefetched(prefetch_key)
+    if prefetched:
+        _logger.debug("Using prefetched related image")
+        illust, illusts = prefetched
+    else:
+        try:
+            illust = await pixiv.related_illust(
+                illust_id, tags=tags, recurse=3, beam=3
+            )
+        except SearchError as e:
+            await helper.edit_error(
+                message=notice_msg,
+                text="Failed to search for related image: <code>{}</code>".format(e),
+            )
+            _logger.warning("Error while searching for related image: {}".format(e))
+            return
 
-    illusts = await _pixiv_dl_illust(
-        quick=quick, illust=illust, pictures=[0], message=notice_msg, to_url=fast
-    )
-    if illusts is dict:
-        await helper.edit_error(**illusts)
-        return
+        illusts = await _pixiv_dl_illust(
+            quick=quick, illust=illust, pictures=[0], message=notice_msg, to_url=fast
+        )
+        if illusts is dict:
+            await helper.edit_error(**illusts)
+            return
 
     _logger.debug("Trying to send images bytes...")
     search_row = []
@@ -355,25 +554,17 @@ async def pixiv_related_cmd(
             sort_popular=sort_popular,
             no_related=no_related,
             translate_tags=translate_tags,
-            fast=fast
+            fast=fast,
+            prefetch_key=related_key,
         )
 
     search_row.append(("Related", cb_related, "pixiv-search-cb-related-{id}"))
 
-    async def cb_getoriginalres(cb_update: Update, _: CallbackContext):
-        clone_context = copy(context)
-        clone_context.args = [str(illust["id"])]
-        return await pixiv_id_cmd(cb_update, clone_context, fast=True)
-
     buttons = helper.buttons_build(
         [
             search_row,
             [
-                (
-                    "All pages",
-                    cb_getoriginalres,
-                    "pixiv-search-cb-originalimage-{id}",
-                ),
+                ("All pages", "pixiv-pages", str(illust["id"]), "named"),
                 (
                     "Download",
                     None,
@@ -387,22 +578,38 @@ async def pixiv_related_cmd(
         ],
         application=context.application,
     )
+    related_key = _pixiv_prefetch(
+        lambda: pixiv.related_illust(illust["id"], tags=tags, recurse=3, beam=3),
+        quick=quick,
+        to_url=fast,
+    )
+
+    async def send(illust_dls: list):
+        return await helper.send(
+            message,
+            lambda: message.reply_photo(
+                photo=_pixiv_photo_from_str_or_bytes(illust_dls, fast=fast),
+                filename=illust_dls[0][1],
+                caption="https://www.pixiv.net/en/artworks/{illust_id}{notice}".format(
+                    illust_id=illust["id"],
+                    notice="\nThis image has low resolution, click <i>All pages</i> to get higher resolution"
+                    if quick
+                    else "",
+                ),
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            ),
+        )
 
-    photo = _pixiv_photo_from_str_or_bytes(illust_dls=illusts, fast=fast)
     try:
-        await message.reply_photo(
-            photo=photo,
-            filename=illusts[0][1],
-            caption="https://www.pixiv.net/en/artworks/{illust_id}{notice}".format(
-                illust_id=illust["id"],
-                notice="\nThis image has low resolution, click <i>All pages</i> to get higher resolution"
-                if quick
-                else "",
+        await _pixiv_send_photos(
+            send,
+            illusts,
+            refetch=lambda: _pixiv_fetch_photos(
+                illust, pictures=[0], quick=quick, to_url=fast, reuse=False
             ),
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
         )
-        await notice_msg.delete()
+        await helper.delete(notice_msg)
     except TelegramError as e:
         await helper.edit_error(
             message=notice_msg, text="Failed to send images: <code>{}</code>".format(e)
@@ -417,6 +624,7 @@ async def pixiv_search_cmd(
     quick: bool = False,
     translate_tags: bool = None,
     fast: bool = False,
+    prefetch_key: str | None = None,
 ):
     logger = parent_logger.getChild("search")
     message: telegram.Message = update.effective_message
@@ -475,15 +683,20 @@ async def pixiv_search_cmd(
         return
 
     if translate_tags:
-        notice_msg = await helper.reply_status(
-            message=message,
-            text="""Translating tags <code>{keyword}</code>...""".format(
-                keyword=", ".join(tags),
-            ),
-            silent=True,
-        )
+        translation = asyncio.ensure_future(pixiv.translate_tags(tags=tags))
+        # Translations are mostly cached, only tell about slow ones instead of
+        # sending a reply edited right after.
+        done, _ = await asyncio.wait({translation}, timeout=0.5)
+        if not done:
+            notice_msg = await helper.reply_status(
+                message=message,
+                text="""Translating tags <code>{keyword}</code>...""".format(
+                    keyword=", ".join(tags),
+                ),
+                silent=True,
+            )
         try:
-            tags = await pixiv.translate_tags(tags=tags)
+            tags = await translation
         except SearchError:
             pass
 
@@ -513,22 +726,33 @@ async def pixiv_search_cmd(
             text=search_txt,
         )
 
-    try:
-        illusts_search = await pixiv.search_illust(tags, sort=sort, related=related)
-    except SearchError as e:
-        await helper.edit_error(
+    prefetched = await _pixiv_prefetched(prefetch_key)
+    if prefetched:
+        logger.debug("Using prefetched search result")
+        illusts_search, illusts = prefetched
+    else:
+        try:
+            illusts_search = await pixiv.search_illust(
+                tags, sort=sort, related=related, pool=True
+            )
+        except SearchError as e:
+            await helper.edit_error(
+                message=notice_msg,
+                text="Failed to search for image: <code>{}</code>".format(e),
+            )
+            logger.warning("Error while searching for images: {}".format(e))
+            return
+
+        illusts = await _pixiv_dl_illust(
+            quick=quick,
+            illust=illusts_search,
+            pictures=[0],
             message=notice_msg,
-            text="Failed to search for image: <code>{}</code>".format(e),
+            to_url=fast,
         )
-        logger.warning("Error while searching for images: {}".format(e))
-        return
-
-    illusts = await _pixiv_dl_illust(
-        quick=quick, illust=illusts_search, pictures=[0], message=notice_msg, to_url=fast
-    )
-    if illusts is dict:
-        await helper.edit_error(**illusts)
-        return
+        if illusts is dict:
+            await helper.edit_error(**illusts)
+            return
 
     logger.debug("Generating callback for button...")
 
@@ -540,6 +764,7 @@ async def pixiv_search_cmd(
             quick=quick,
             translate_tags=translate_tags,
             fast=fast,
+            prefetch_key=next_key,
         )
 
     async def cb_related(_: Update, __: CallbackContext):
@@ -561,11 +786,6 @@ async def pixiv_search_cmd(
             fast=fast,
         )
 
-    async def cb_getoriginalres(cb_update: Update, _: CallbackContext):
-        clone_context = copy(context)
-        clone_context.args = [str(illusts_search["id"])]
-        return await pixiv_id_cmd(cb_update, clone_context, fast=True)
-
     buttons = helper.buttons_build(
         [
             [
@@ -573,11 +793,7 @@ async def pixiv_search_cmd(
                 ("Related", cb_related, "pixiv-search-cb-related-{id}"),
             ],
             [
-                (
-                    "All pages",
-                    cb_getoriginalres,
-                    "pixiv-search-cb-originalimage-{id}",
-                ),
+                ("All pages", "pixiv-pages", str(illusts_search["id"]), "named"),
                 (
                     "Download",
                     None,
@@ -593,23 +809,44 @@ async def pixiv_search_cmd(
         ],
         application=context.application,
     )
+    next_key = _pixiv_prefetch(
+        lambda: pixiv.search_illust(tags, sort=sort, related=related, pool=True),
+        quick=quick,
+        to_url=fast,
+        # The result was taken from the shared pool, don't lose it.
+        unused=lambda illust: pixiv.return_search_result(
+            tags, illust, related=related, sort=sort
+        ),
+    )
+
+    async def send(illust_dls: list):
+        photo = _pixiv_photo_from_str_or_bytes(illust_dls, fast=fast)
+        _logger.debug(photo)
+        return await helper.send(
+            message,
+            lambda: message.reply_photo(
+                photo=photo,
+                filename=illust_dls[0][1],
+                caption="https://www.pixiv.net/en/artworks/{illust_id}{notice}".format(
+                    illust_id=illusts_search["id"],
+                    notice="\nThis image has low resolution, click <i>All pages</i> to get higher resolution"
+                    if quick
+                    else "",
+                ),
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+            ),
+        )
 
-    photo = _pixiv_photo_from_str_or_bytes(illust_dls=illusts, fast=fast)
-    _logger.debug(photo)
     try:
-        await message.reply_photo(
-            photo=photo,
-            filename=illusts[0][1],
-            caption="https://www.pixiv.net/en/artworks/{illust_id}{notice}".format(
-                illust_id=illusts_search["id"],
-                notice="\nThis image has low resolution, click <i>All pages</i> to get higher resolution"
-                if quick
-                else "",
+        await _pixiv_send_photos(
+            send,
+            illusts,
+            refetch=lambda: _pixiv_fetch_photos(
+                illusts_search, pictures=[0], quick=quick, to_url=fast, reuse=False
             ),
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
         )
-        await notice_msg.delete()
+        await helper.delete(notice_msg)
     except TelegramError as e:
         await helper.edit_error(
             message=notice_msg, text="Failed to send images: <code>{}</code>".format(e)
@@ -675,9 +912,12 @@ def init_pixiv(application: Application) -> bool:
             "Logging into Pixiv failed, disabling Pixiv-related feature: {}".format(e)
         )
         return False
-    pixiv.flask_api(app=app)
+    if web_app is not None:
+        pixiv.aiohttp_api(app=web_app)
+    else:
+        pixiv.flask_api(app=app)
     _logger.info("Loading Pixiv commands...")
-    application.add_handler(CommandHandler("pixiv", pixiv_cmd))
+    application.add_handler(CommandHandler("pixiv", scheduler.wrap(pixiv_cmd)))
     return True
 
 
@@ -686,12 +926,49 @@ def init_flask():
     def root():
         return "AyayaXYZ is running correctly."
 
+    @app.route("/stats")
+    def stats():
+        return bot_stats()
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return metrics.REGISTRY.render(), {"Content-Type": metrics.REGISTRY.CONTENT_TYPE}
+
     thread = Thread(
         target=serve, kwargs={"app": app, "host": "0.0.0.0", "port": "8080"}
     )
     thread.daemon = True
     thread.start()
 
+
+async def start_aiohttp():
+    async def root(_: web.Request):
+        return web.Response(text="AyayaXYZ is running correctly.")
+
+    async def stats(_: web.Request):
+        return web.json_response(bot_stats())
+
+    async def prometheus_metrics(_: web.Request):
+        return web.Response(
+            text=metrics.REGISTRY.render(),
+            headers={"Content-Type": metrics.REGISTRY.CONTENT_TYPE},
+        )
+
+    web_app.router.add_get("/", root)
+    web_app.router.add_get("/stats", stats)
+    web_app.router.add_get("/metrics", prometheus_metrics)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=8080).start()
+    _logger.info("Web API is served from the bot's event loop")
+
+
+async def post_init(_: Application):
+    # Downloads run on the bot's event loop, Flask requests are bridged to it.
+    pixiv.attach()
+    if web_app is not None:
+        await start_aiohttp()
+
 async def sauce_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.effective_message
     # logger = _logger.getChild("commands.sauce")
@@ -745,12 +1022,25 @@ def main():
     logging.info("Initializing logging...")
     loglevel = os.getenv("LOGLEVEL", "INFO")
     _logger.setLevel(loglevel)
-    application = ApplicationBuilder().token(os.getenv("TOKEN")).build()
+    builder = ApplicationBuilder().token(os.getenv("TOKEN"))
+    if update_workers > 1:
+        # Let every update in, the scheduler enforces the limits.
+        builder = builder.concurrent_updates(True).connection_pool_size(
+            update_workers * 2
+        )
+    application = builder.post_init(post_init).build()
+    helper.callbacks.install(application, wrap=scheduler.wrap)
     init_pixiv(application=application)
-    init_flask()
+    if web_app is None:
+        init_flask()
     _logger.info("Loading default commands...")
     _logger.info("Logging level: {}".format(loglevel))
     _logger.info("Web API Url: {}".format(web_url))
     _logger.debug("Say hi!")
-    application.add_handlers([CommandHandler("sauce", sauce_cmd), CommandHandler("start", start_cmd)])
+    application.add_handlers(
+        [
+            CommandHandler("sauce", scheduler.wrap(sauce_cmd)),
+            CommandHandler("start", scheduler.wrap(start_cmd)),
+        ]
+    )
     application.run_polling()
@@ -0,0 +1,68 @@
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+
+
+class FileId(str):
+    """A Telegram file ID, as opposed to the URL of an image"""
+
+
+class FileIdStore:
+    """Persistent source URL -> Telegram file ID mapping
+
+    Files sent once can be sent again by their file ID, without downloading
+    nor uploading them. A stale file ID (e.g. after changing the bot token)
+    should be forgotten when Telegram rejects it.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS file_ids (
+                source TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        self._db.commit()
+
+    def get(self, source: str) -> FileId | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_id FROM file_ids WHERE source = ?", (source,)
+            ).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return FileId(row[0])
+
+    def put(self, source: str, file_id: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?)",
+                (source, file_id, time.time()),
+            )
+            self._db.commit()
+
+    def forget(self, source: str):
+        with self._lock:
+            self._db.execute("DELETE FROM file_ids WHERE source = ?", (source,))
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._db.execute("SELECT COUNT(*) FROM file_ids").fetchone()
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+            }
@@ -1,8 +1,293 @@
+import asyncio
+import logging
+import time
 import uuid
-from typing import Any
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Awaitable, Callable
 
-from telegram import Message, InlineKeyboardButton
-from telegram.ext import Application, CallbackQueryHandler
+from telegram import Message, InlineKeyboardButton, Update
+from telegram.error import RetryAfter
+from telegram.ext import Application, CallbackContext, CallbackQueryHandler
+
+from ayayaxyz.metrics import STAGE_SECONDS
+
+_logger = logging.getLogger("ayayaxyz.helper")
+
+
+class CallbackRegistry:
+    """Routes every callback query through a single CallbackQueryHandler
+
+    Button callbacks are closures, they are kept in memory for `ttl` seconds
+    (at most `max_entries` of them, least recently used are dropped first).
+    Named callbacks (see `named_callback`) are resolved from the callback data
+    alone, so their buttons keep working after a restart.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 7 * 86400):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = Lock()
+        # Callback data -> (expiry, callback), least recently used first.
+        self._callbacks: OrderedDict[str, tuple[float, Callable]] = OrderedDict()
+        self._named: dict[str, Callable] = {}
+        self._applications: set[int] = set()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def install(self, application: Application, wrap: Callable | None = None):
+        """Adds the dispatching handler to `application`, once
+
+        + `wrap`: decorator applied to the dispatcher (e.g. a scheduler)
+        """
+        if id(application) in self._applications:
+            return
+        self._applications.add(id(application))
+        dispatch = self.dispatch if wrap is None else wrap(self.dispatch)
+        application.add_handler(CallbackQueryHandler(dispatch))
+
+    def register(self, data: str, callback: Callable):
+        with self._lock:
+            self._callbacks.pop(data, None)
+            self._callbacks[data] = (time.monotonic() + self._ttl, callback)
+            while len(self._callbacks) > self._max_entries:
+                self._callbacks.popitem(last=False)
+                self._evictions += 1
+
+    def named(
+        self, name: str, callback: Callable[[Update, CallbackContext, str], Awaitable]
+    ):
+        self._named[name] = callback
+
+    def get(self, data: str) -> Callable | None:
+        if data.startswith("@"):
+            name, _, arg = data[1:].partition(":")
+            callback = self._named.get(name)
+            if callback is None:
+                return None
+            return lambda update, context: callback(update, context, arg)
+        with self._lock:
+            entry = self._callbacks.get(data)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._callbacks[data]
+                    self._evictions += 1
+                self._misses += 1
+                return None
+            self._callbacks.move_to_end(data)
+            self._hits += 1
+            return entry[1]
+
+    async def dispatch(self, update: Update, context: CallbackContext):
+        query = update.callback_query
+        callback = self.get(query.data or "")
+        if callback is None:
+            _logger.debug("Expired callback {}".format(query.data))
+            await query.answer("This button has expired.")
+            return
+        return await callback(update, context)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._callbacks),
+                "named": len(self._named),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+callbacks = CallbackRegistry()
+
+
+class _Pace:
+    """Token bucket for a single event loop, `rate` is in messages per second"""
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        # Tokens are counted from here, in the future after a flood wait.
+        self.updated = time.monotonic()
+
+    def reserve(self, cost: float) -> float:
+        """Takes `cost` tokens, returns how long to wait before using them"""
+        now = time.monotonic()
+        if now > self.updated:
+            self._tokens = min(
+                self._burst, self._tokens + (now - self.updated) * self._rate
+            )
+            self.updated = now
+        self._tokens -= cost
+        return max(0.0, self.updated - now - min(0.0, self._tokens) / self._rate)
+
+    def pause(self, seconds: float):
+        self._tokens = min(self._tokens, 0)
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+class _PendingEdit:
+    def __init__(self, request: Callable[[], Awaitable]):
+        self.request = request
+        self.superseded = False
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class SendQueue:
+    """Paces outgoing Telegram requests to stay under the flood limits
+
+    + `global_rate`: messages per second, across all chats
+    + `chat_rate`, `chat_burst`: messages per second (and at once) per chat
+    + `max_retries`: retries after a RetryAfter error, waiting as asked
+
+    Edits of a message which is still waiting for its turn are merged, only
+    the last one is sent. Those of a message being deleted are dropped.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 25,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        max_retries: int = 3,
+    ):
+        self._global = _Pace(global_rate, burst=global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._chats: dict[int, _Pace] = {}
+        self._edits: dict[tuple[int, int], _PendingEdit] = {}
+        self._sent = 0
+        self._retries = 0
+        self._merged = 0
+        self._waits = 0
+        self._wait_total = 0.0
+
+    def _chat(self, chat_id: int) -> _Pace:
+        pace = self._chats.get(chat_id)
+        if pace is None:
+            if len(self._chats) > 1024:
+                # Forget chats which have been idle for a while.
+                idle = time.monotonic() - 60
+                for key in [k for k, v in self._chats.items() if v.updated < idle]:
+                    del self._chats[key]
+            pace = self._chats[chat_id] = _Pace(self._chat_rate, self._chat_burst)
+        return pace
+
+    async def _wait(self, chat_id: int, cost: float):
+        wait = max(self._chat(chat_id).reserve(cost), self._global.reserve(cost))
+        if wait > 0:
+            self._waits += 1
+            self._wait_total += wait
+            await asyncio.sleep(wait)
+
+    async def _send(self, chat_id: int, request: Callable[[], Awaitable], cost: float):
+        for attempt in range(self._max_retries + 1):
+            try:
+                with STAGE_SECONDS.time(stage="telegram_send"):
+                    result = await request()
+            except RetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                delay = e.retry_after
+                delay = getattr(delay, "total_seconds", lambda: delay)()
+                _logger.info(
+                    "Flood control in chat {}, retrying in {}s".format(chat_id, delay)
+                )
+                self._retries += 1
+                self._chat(chat_id).pause(delay)
+                await self._wait(chat_id, cost)
+            else:
+                self._sent += 1
+                return result
+
+    async def send(
+        self, chat_id: int, request: Callable[[], Awaitable], cost: float = 1
+    ) -> Any:
+        """Runs `request()` once allowed, `cost` is the number of messages sent"""
+        await self._wait(chat_id, cost)
+        return await self._send(chat_id, request, cost)
+
+    async def edit(self, message: Message, request: Callable[[], Awaitable]) -> Any:
+        """Same as `send`, merged with the pending edits of `message`"""
+        key = (message.chat_id, message.message_id)
+        pending = self._edits.get(key)
+        if pending is not None:
+            pending.request = request
+            self._merged += 1
+            try:
+                return await asyncio.shield(pending.future)
+            except asyncio.CancelledError:
+                if not pending.future.cancelled():
+                    raise
+            # The edit it was merged into got cancelled, send it again.
+            return await self.edit(message, request)
+        pending = self._edits[key] = _PendingEdit(request)
+        try:
+            try:
+                await self._wait(message.chat_id, 1)
+            finally:
+                if self._edits.get(key) is pending:
+                    del self._edits[key]
+            if pending.superseded:
+                result = None
+            else:
+                result = await self._send(message.chat_id, pending.request, 1)
+        except Exception as e:
+            pending.future.set_exception(e)
+            # Merged edits may not be waiting for it anymore.
+            pending.future.exception()
+            raise
+        except BaseException:
+            pending.future.cancel()
+            raise
+        pending.future.set_result(result)
+        return result
+
+    async def delete(self, message: Message) -> Any:
+        pending = self._edits.get((message.chat_id, message.message_id))
+        if pending is not None:
+            pending.superseded = True
+        return await self.send(message.chat_id, message.delete)
+
+    def stats(self) -> dict:
+        return {
+            "sent": self._sent,
+            "retries": self._retries,
+            "merged_edits": self._merged,
+            "pending_edits": len(self._edits),
+            "waits": self._waits,
+            "wait_total": self._wait_total,
+        }
+
+
+sender = SendQueue()
+
+
+async def send(message: Message, request: Callable[[], Awaitable], cost: float = 1):
+    """Sends `request()` (e.g. a reply to `message`) through the send queue"""
+    return await sender.send(message.chat_id, request, cost=cost)
+
+
+async def delete(message: Message):
+    return await sender.delete(message)
+
+
+def named_callback(name: str):
+    """Registers a callback which survives restarts, decorator
+
+    The callback receives the argument from the button as a third parameter.
+    Use it with `("text", name, argument, "named")` buttons, the name and the
+    argument must fit in 63 bytes.
+    """
+
+    def decorator(callback):
+        callbacks.named(name, callback)
+        return callback
+
+    return decorator
 
 
 async def reply_status(message: Message, text: str, silent=False, **kwargs):
@@ -43,14 +328,23 @@ async def reply_html(message: Message, text: str, silent=False, **kwargs):
     + `message`: a telegram.Message object
     + `text`: a HTML string to be sent
     """
-    return await message.reply_html(
-        text=text, disable_web_page_preview=True, disable_notification=silent, **kwargs
+    return await send(
+        message,
+        lambda: message.reply_html(
+            text=text,
+            disable_web_page_preview=True,
+            disable_notification=silent,
+            **kwargs,
+        ),
     )
 
 
 async def edit_html(message: Message, text: str, **kwargs):
-    return await message.edit_text(
-        text=text, parse_mode="HTML", disable_web_page_preview=True, **kwargs
+    return await sender.edit(
+        message,
+        lambda: message.edit_text(
+            text=text, parse_mode="HTML", disable_web_page_preview=True, **kwargs
+        ),
     )
 
 
@@ -65,16 +359,18 @@ def button_build(button: tuple[str, Any, str, str], application: Application):
     pattern = button[2].format(id=id)
     match type:
         case "callback":
-            application.add_handler(
-                CallbackQueryHandler(
-                    button[1],
-                    pattern,
-                )
-            )
+            callbacks.install(application)
+            callbacks.register(pattern, button[1])
             button = InlineKeyboardButton(
                 button[0],
                 callback_data=pattern,
             )
+        case "named":
+            callbacks.install(application)
+            button = InlineKeyboardButton(
+                button[0],
+                callback_data="@{}:{}".format(button[1], pattern),
+            )
         case "url":
             button = InlineKeyboardButton(
                 button[0],
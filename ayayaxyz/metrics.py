@@ -0,0 +1,281 @@
+import functools
+import inspect
+import math
+import time
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Any, Callable, Iterable
+
+# Seconds, from a cached tag lookup to a large ugoira conversion.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# (name, type, help, [(sample name, labels, value)])
+Family = tuple[str, str, str, list[tuple[str, dict[str, str], float]]]
+
+# Keys of the `stats()` dicts which only ever grow, the others are levels.
+COUNTER_STATS = frozenset(
+    {
+        "hits",
+        "misses",
+        "evictions",
+        "evicted_bytes",
+        "requests",
+        "throttled",
+        "waits",
+        "wait_total",
+        "processed",
+        "sent",
+        "retries",
+        "merged_edits",
+    }
+)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for key, value in labels.items()
+        )
+    )
+
+
+class _Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self._labels = tuple(labels)
+        self._lock = Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self._labels):
+            raise ValueError(
+                "{} expects labels {}, got {}".format(
+                    self.name, self._labels, tuple(labels)
+                )
+            )
+        return tuple(str(labels[label]) for label in self._labels)
+
+    @abstractmethod
+    def collect(self) -> list[Family]:
+        """Returns the families to render, computed when scraped"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> list[Family]:
+        with self._lock:
+            samples = [
+                (self.name, dict(zip(self._labels, key)), value)
+                for key, value in self._values.items()
+            ]
+        return [(self.name, self.kind, self.documentation, samples)]
+
+
+class _Timer:
+    """Observes the time spent in a `with` block or a (sync or async) function"""
+
+    def __init__(self, histogram: "Histogram", labels: dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+    def __call__(self, func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                with _Timer(self._histogram, self._labels):
+                    return await func(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                with _Timer(self._histogram, self._labels):
+                    return func(*args, **kwargs)
+
+        return timed
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Labels -> (count per bucket, sum)
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self._buckets)
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def time(self, **labels: str) -> _Timer:
+        """Context manager (or function decorator) observing its duration"""
+        self._key(labels)
+        return _Timer(self, labels)
+
+    def collect(self) -> list[Family]:
+        with self._lock:
+            values = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._values.items()
+            ]
+        samples = []
+        for key, counts, total in values:
+            labels = dict(zip(self._labels, key))
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                samples.append(
+                    (
+                        self.name + "_bucket",
+                        {**labels, "le": _format_value(bound)},
+                        cumulative,
+                    )
+                )
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, cumulative))
+        return [(self.name, self.kind, self.documentation, samples)]
+
+
+def stats_families(
+    prefix: str, stats: dict, counters: frozenset[str] = COUNTER_STATS
+) -> list[Family]:
+    """Exports a `stats()` dict, nested keys are joined with "_"
+
+    Keys in `counters` are exported as counters (with a "_total" suffix), the
+    others as gauges. Booleans and non numeric values are skipped.
+    """
+    families = []
+    for key, value in stats.items():
+        name = "{}_{}".format(prefix, key)
+        if isinstance(value, dict):
+            families += stats_families(name, value, counters)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if key in counters:
+                if not name.endswith("_total"):
+                    name += "_total"
+                families.append((name, "counter", "", [(name, {}, value)]))
+            else:
+                families.append((name, "gauge", "", [(name, {}, value)]))
+    return families
+
+
+class Registry:
+    """Metrics exposed in the Prometheus text format
+
+    `add_collector` registers a function returning families computed when
+    scraped (e.g. from the `stats()` of a cache, see `stats_families`).
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Callable[[], Iterable[Family]]] = []
+        self._lock = Lock()
+
+    def _register(self, metric: Any) -> Any:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric {} already exists".format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        families = []
+        for metric in metrics:
+            families += metric.collect()
+        for collector in collectors:
+            families += collector()
+        lines = []
+        for name, kind, documentation, samples in families:
+            if documentation:
+                lines.append("# HELP {} {}".format(name, documentation))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in samples:
+                lines.append(
+                    "{}{} {}".format(sample, _format_labels(labels), _format_value(value))
+                )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "ayayaxyz_stage_duration_seconds",
+    "Time spent in each stage of a request",
+    labels=("stage",),
+)
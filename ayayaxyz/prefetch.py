@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+_logger = logging.getLogger("ayayaxyz.prefetch")
+
+
+class Prefetcher:
+    """Speculatively runs jobs whose result will likely be asked for soon
+
+    + `max_concurrency`: prefetch jobs running at the same time
+    + `max_entries`: prefetched results (running or done) kept at the same time
+    + `max_bytes`: total size of the unclaimed results, as measured by `sizeof`
+    + `ttl`: seconds before an unclaimed prefetch is discarded
+    + `delay`: seconds to wait before starting, so user requests go first
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 2,
+        max_entries: int = 16,
+        max_bytes: int | None = None,
+        sizeof: Callable[[Any], int] = lambda _: 0,
+        ttl: float = 120,
+        delay: float = 1,
+    ):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._ttl = ttl
+        self._delay = delay
+        # Key -> (task, called when the result is thrown away)
+        self._jobs: dict[str, tuple[asyncio.Task, Callable[[], Any] | None]] = {}
+        # Key -> size of the finished, unclaimed results
+        self._sizes: dict[str, int] = {}
+        self._bytes = 0
+
+    def _over_budget(self, size: int = 0) -> bool:
+        return self._max_bytes is not None and self._bytes + size > self._max_bytes
+
+    def schedule(
+        self,
+        key: str,
+        job: Callable[[], Awaitable[Any]],
+        on_discard: Callable[[], Any] | None = None,
+    ) -> bool:
+        """Starts prefetching `job()` under `key`, unless over budget
+
+        `on_discard` is called if the prefetch expires unclaimed or fails, e.g.
+        to give back what the job took from a shared pool.
+        """
+        if (
+            key in self._jobs
+            or len(self._jobs) >= self._max_entries
+            or self._over_budget()
+        ):
+            return False
+        task = asyncio.create_task(self._run(key, job))
+        # Don't complain about failures nobody asked for.
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._jobs[key] = (task, on_discard)
+        asyncio.get_running_loop().call_later(self._ttl, self._discard, key, task)
+        return True
+
+    async def _run(self, key: str, job: Callable[[], Awaitable[Any]]) -> Any:
+        await asyncio.sleep(self._delay)
+        async with self._semaphore:
+            _logger.debug("Prefetching {}".format(key))
+            result = await job()
+        if self._jobs.get(key, (None,))[0] is not asyncio.current_task():
+            # Already claimed (or discarded), not kept around anymore.
+            return result
+        size = self._sizeof(result)
+        if self._over_budget(size):
+            _logger.debug("Prefetch {} is over budget ({} bytes)".format(key, size))
+            _, on_discard = self._jobs.pop(key)
+            self._call_discard(key, on_discard)
+            return None
+        self._sizes[key] = size
+        self._bytes += size
+        return result
+
+    def _forget(self, key: str) -> tuple[asyncio.Task | None, Callable[[], Any] | None]:
+        self._bytes -= self._sizes.pop(key, 0)
+        return self._jobs.pop(key, (None, None))
+
+    @staticmethod
+    def _call_discard(key: str, on_discard: Callable[[], Any] | None):
+        if on_discard is None:
+            return
+        try:
+            on_discard()
+        except Exception as e:
+            _logger.warning("Failed to discard prefetch {}: {}".format(key, e))
+
+    def _discard(self, key: str, task: asyncio.Task):
+        if key not in self._jobs or self._jobs[key][0] is not task:
+            return
+        _logger.debug("Discarding stale prefetch {}".format(key))
+        _, on_discard = self._forget(key)
+        task.cancel()
+        self._call_discard(key, on_discard)
+
+    async def take(self, key: str) -> Any | None:
+        """Returns the prefetched result for `key`, waiting for it if needed
+
+        Returns None if nothing was prefetched or the prefetch failed.
+        """
+        task, on_discard = self._forget(key)
+        if task is None:
+            return None
+        try:
+            return await task
+        except Exception as e:
+            _logger.debug("Prefetch {} failed: {}".format(key, e))
+            self._call_discard(key, on_discard)
+            return None
+        except asyncio.CancelledError:
+            if task.cancelled():
+                self._call_discard(key, on_discard)
+                return None
+            raise
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+_logger = logging.getLogger("ayayaxyz.scheduler")
+
+
+class ChatScheduler:
+    """Runs update handlers concurrently, but one at a time for each chat
+
+    + `max_workers`: handlers running at the same time, across all chats
+    + `slow_wait`: waits longer than this (in seconds) are logged
+
+    Updates from a chat wait for the previous ones from the same chat (in the
+    order they arrived) before waiting for a free worker, so a busy chat can't
+    hold workers other chats could use.
+    """
+
+    def __init__(self, max_workers: int = 8, slow_wait: float = 5):
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._max_workers = max_workers
+        self._slow_wait = slow_wait
+        # Chat ID -> (lock, updates queued or running for the chat)
+        self._chats: dict[int | None, tuple[asyncio.Lock, int]] = {}
+        self._queued = 0
+        self._running = 0
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def wrap(
+        self, callback: Callable[[Update, CallbackContext], Awaitable[Any]]
+    ) -> Callable[[Update, CallbackContext], Awaitable[Any]]:
+        """Returns a handler callback running `callback` through the scheduler"""
+
+        async def scheduled(update: Update, context: CallbackContext):
+            return await self.run(update, lambda: callback(update, context))
+
+        return scheduled
+
+    async def run(self, update: Update, job: Callable[[], Awaitable[Any]]) -> Any:
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        lock, users = self._chats.get(chat_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._chats[chat_id] = (lock, users + 1)
+        queued_at = time.monotonic()
+        self._queued += 1
+        waiting = True
+        try:
+            async with lock, self._semaphore:
+                waiting = False
+                self._queued -= 1
+                self._record_wait(time.monotonic() - queued_at, chat_id)
+                self._running += 1
+                try:
+                    return await job()
+                finally:
+                    self._running -= 1
+                    self._processed += 1
+        finally:
+            if waiting:
+                self._queued -= 1
+            lock, users = self._chats[chat_id]
+            if users == 1:
+                del self._chats[chat_id]
+            else:
+                self._chats[chat_id] = (lock, users - 1)
+
+    def _record_wait(self, wait: float, chat_id: int | None):
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        if wait > self._slow_wait:
+            _logger.info(
+                "Update from chat {} waited {:.1f}s ({} queued, {} running)".format(
+                    chat_id, wait, self._queued, self._running
+                )
+            )
+
+    def stats(self) -> dict:
+        started = self._processed + self._running
+        return {
+            "max_workers": self._max_workers,
+            "queued": self._queued,
+            "running": self._running,
+            "processed": self._processed,
+            "chats": len(self._chats),
+            "wait_avg": self._wait_total / started if started else 0.0,
+            "wait_max": self._wait_max,
+        }
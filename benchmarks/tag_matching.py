@@ -0,0 +1,168 @@
+"""Compares TagMatcher with the previous _image_from_tag_matching implementation
+
+Run from the repository root: python -m benchmarks.tag_matching
+"""
+import random
+import timeit
+from random import randint
+
+from ayayaxyz.api.pixiv.exceptions import SearchError
+from ayayaxyz.api.pixiv.matcher import TagMatcher
+
+WORDS = [
+    "genshin", "impact", "hu", "tao", "ayaka", "kamisato", "keqing", "eula",
+    "girl", "boy", "original", "landscape", "sky", "cat", "sword", "smile",
+]
+QUERY = ["genshin impact", "hu tao"]
+EXCLUDE = ["-keqing"]
+
+
+def legacy_image_from_tag_matching(images, tags=None, exclude_tags=None) -> dict:
+    """_image_from_tag_matching as of the baseline, without logging"""
+
+    def get_raw_tags(image):
+        return [tag["name"] for tag in image["tags"]]
+
+    if tags is None:
+        return images[randint(0, len(images) - 1)]
+    if exclude_tags is None:
+        exclude_tags = set()
+    else:
+        exclude_tags = set(x.lower()[1:] for x in exclude_tags)
+    tags = set(x.lower() for x in tags)
+    image = None
+    searched_images = []
+    while image is None:
+        if len(searched_images) == len(images):
+            raise SearchError("Couldn't find any images matching provided keywords")
+        while True:
+            image_count = randint(0, len(images) - 1)
+            if image_count not in searched_images:
+                break
+        searched_images.append(image_count)
+        current_image = images[image_count]
+        r18_image = "R-18" in get_raw_tags(current_image)
+        if r18_image and "r-18" not in tags:
+            continue
+        elif not r18_image and "r-18" in tags:
+            continue
+        found_tags = set()
+        found_bl_tags = set()
+        found_tags_jw = set()
+        for tag in current_image["tags"]:
+            if exclude_tags:
+                for kw in exclude_tags:
+                    kw_set = set(kw.split(" "))
+                    if tag["translated_name"] is not None and kw_set.issubset(
+                        tag["translated_name"].lower().split(" ")
+                    ):
+                        found_bl_tags.add(kw)
+                        continue
+                    if kw_set.issubset(tag["name"].lower().split(" ")):
+                        found_bl_tags.add(kw)
+                        continue
+            for kw in tags:
+                kw_list = kw.split(" ")
+                kw_set = set(kw_list)
+                if tag["translated_name"] is not None and kw_set.issubset(
+                    tag["translated_name"].lower().split(" ")
+                ):
+                    found_tags.add(kw)
+                    continue
+                if kw_set.issubset(tag["name"].lower().split(" ")):
+                    found_tags.add(kw)
+                    continue
+                kw_joined = "".join(kw_list)
+                kw_check_list = [kw_joined]
+                if len(kw_list) == 2:
+                    kw_list[0], kw_list[1] = kw_list[1], kw_list[0]
+                    kw_check_list.append("".join(kw_list))
+                if tag["name"].lower() in kw_check_list:
+                    found_tags_jw.add(kw)
+                    continue
+                if (
+                    tag["translated_name"] is not None
+                    and tag["translated_name"].lower() in kw_check_list
+                ):
+                    found_tags_jw.add(kw)
+                    continue
+        found_tags.update(found_tags_jw)
+        if tags == found_tags:
+            if found_bl_tags and found_bl_tags.issubset(exclude_tags):
+                continue
+            image = current_image
+    return image
+
+
+def _random_tag(rng: random.Random) -> dict:
+    name = " ".join(rng.sample(WORDS, rng.randint(1, 2)))
+    if rng.random() < 0.1:
+        name = name.replace(" ", "")
+    translated = None
+    if rng.random() < 0.5:
+        translated = name.title()
+        name = "tag{}".format(rng.randint(0, 999))
+    return {"name": name, "translated_name": translated}
+
+
+def make_illusts(count: int, match_ratio: float, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    illusts = []
+    for illust_id in range(count):
+        tags = [_random_tag(rng) for _ in range(rng.randint(5, 12))]
+        if rng.random() < match_ratio:
+            tags.append({"name": "原神", "translated_name": "Genshin Impact"})
+            tags.append({"name": "taohu", "translated_name": None})
+        if rng.random() < 0.1:
+            tags.append({"name": "R-18", "translated_name": None})
+        illusts.append({"id": illust_id, "tags": tags})
+    return illusts
+
+
+def _legacy_matches(illust: dict) -> bool:
+    try:
+        legacy_image_from_tag_matching([illust], QUERY, EXCLUDE)
+    except SearchError:
+        return False
+    return True
+
+
+def main():
+    checked = make_illusts(2000, match_ratio=0.3, seed=1)
+    matcher = TagMatcher(QUERY, EXCLUDE)
+    mismatches = sum(matcher.matches(x) != _legacy_matches(x) for x in checked)
+    print("Semantics check: {} mismatches over {} illusts".format(mismatches, len(checked)))
+
+    print("{:>8} {:>8} {:>14} {:>14} {:>8}".format("illusts", "match", "legacy (us)", "matcher (us)", "speedup"))
+    for count in (30, 300, 3000):
+        for match_ratio in (0.5, 0.05, 0.0):
+            illusts = make_illusts(count, match_ratio)
+            number = max(20, 6000 // count)
+
+            def legacy():
+                try:
+                    legacy_image_from_tag_matching(illusts, QUERY, EXCLUDE)
+                except SearchError:
+                    pass
+
+            def current():
+                try:
+                    TagMatcher(QUERY, EXCLUDE).select(illusts)
+                except SearchError:
+                    pass
+
+            legacy_time = min(timeit.repeat(legacy, number=number, repeat=5)) / number
+            current_time = min(timeit.repeat(current, number=number, repeat=5)) / number
+            print(
+                "{:>8} {:>8} {:>14.1f} {:>14.1f} {:>7.1f}x".format(
+                    count,
+                    match_ratio,
+                    legacy_time * 1e6,
+                    current_time * 1e6,
+                    legacy_time / current_time,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
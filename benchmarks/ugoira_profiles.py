@@ -0,0 +1,135 @@
+"""Compares the ugoira encoder profiles on ugoira ZIPs
+
+Run from the repository root (ffmpeg has to be in the PATH):
+
+    python -m benchmarks.ugoira_profiles [--generate DIR] [ZIP ...]
+
+Frame delays are read from an animation.json in the ZIP if there is one
+(pixiv's "frames" list, or the "ugokuIllustData" object of the downloader
+format), otherwise every frame lasts --delay milliseconds.
+"""
+import argparse
+import asyncio
+import json
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+from ayayaxyz.api.pixiv.ugoira import PROFILES, encode_zip
+
+FIXTURES = {
+    # name: (size, frame count, frame delays in ms repeated over the frames)
+    "small": ("320x320", 24, [60]),
+    "medium": ("600x600", 60, [150, 50]),
+    "large": ("1200x900", 90, [40, 80, 120]),
+}
+
+
+def generate(directory: Path) -> list[Path]:
+    """Builds test ugoira ZIPs with ffmpeg's testsrc, with their animation.json"""
+    directory.mkdir(parents=True, exist_ok=True)
+    zips = []
+    for name, (size, count, delays) in FIXTURES.items():
+        archive = directory.joinpath("{}_ugoira{}.zip".format(name, size))
+        zips.append(archive)
+        if archive.is_file():
+            continue
+        with tempfile.TemporaryDirectory() as tmp:
+            subprocess.run(
+                [
+                    "ffmpeg", "-loglevel", "error", "-y",
+                    "-f", "lavfi", "-i", "testsrc=size={}:rate=10".format(size),
+                    "-frames:v", str(count), "-q:v", "3",
+                    "{}/%06d.jpg".format(tmp),
+                ],
+                check=True,
+            )
+            frames = [
+                {"file": "{:06d}.jpg".format(i + 1), "delay": delays[i % len(delays)]}
+                for i in range(count)
+            ]
+            with ZipFile(archive, "w") as f:
+                for frame in frames:
+                    f.write(Path(tmp).joinpath(frame["file"]), frame["file"])
+                f.writestr("animation.json", json.dumps({"frames": frames}))
+    return zips
+
+
+def read_frames(archive: Path, delay: int) -> list[dict]:
+    with ZipFile(archive) as f:
+        names = f.namelist()
+        if "animation.json" in names:
+            animation = json.loads(f.read("animation.json"))
+            animation = animation.get("ugokuIllustData", animation)
+            return animation["frames"]
+    return [
+        {"file": name, "delay": delay}
+        for name in sorted(names)
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".gif"))
+    ]
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run(zips: list[Path], profiles: list[str], delay: int):
+    print(
+        "{:<28} {:<10} {:>8} {:>9} {:>10} {:>10}".format(
+            "zip", "profile", "frames", "wall (s)", "cpu (s)", "size (KiB)"
+        )
+    )
+    with tempfile.TemporaryDirectory() as out_dir:
+        for archive in zips:
+            frames = read_frames(archive, delay)
+            for name in profiles:
+                profile = PROFILES[name]
+                out = Path(out_dir).joinpath("{}-{}.{}".format(archive.stem, name, profile.extension))
+                cpu = children_cpu()
+                start = time.perf_counter()
+                await encode_zip(archive, frames, out, profile, quiet=True)
+                wall = time.perf_counter() - start
+                cpu = children_cpu() - cpu
+                print(
+                    "{:<28} {:<10} {:>8} {:>9.2f} {:>10.2f} {:>10.1f}".format(
+                        archive.name[:28],
+                        name,
+                        len(frames),
+                        wall,
+                        cpu,
+                        out.stat().st_size / 1024,
+                    )
+                )
+                out.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("zips", nargs="*", type=Path, help="ugoira ZIP files")
+    parser.add_argument(
+        "--generate", type=Path, metavar="DIR", help="generate test ZIPs in DIR"
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        choices=list(PROFILES),
+        help="profile to run (can be repeated, default is all of them)",
+    )
+    parser.add_argument(
+        "--delay", type=int, default=100, help="frame delay for ZIPs without animation.json"
+    )
+    args = parser.parse_args()
+    zips = list(args.zips)
+    if args.generate:
+        zips += generate(args.generate)
+    if not zips:
+        parser.error("pass ugoira ZIPs and/or --generate DIR")
+    asyncio.run(run(zips, args.profile or list(PROFILES), args.delay))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 from subprocess import Popen, PIPE
 from pathlib import Path
 
-packages = ["telegram", "requests_cache", "flask", "waitress", "pixivpy3", "saucerer"]
+packages = ["telegram", "flask", "waitress", "pixivpy3", "saucerer", "aiohttp", "PIL"]
 data_packages = ["cloudscraper"]
 ext_blacklist = [".sqlite", ".json", ".pem"]
 
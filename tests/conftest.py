@@ -0,0 +1,13 @@
+import pytest
+
+from ayayaxyz.api.pixiv import Pixiv
+
+
+@pytest.fixture
+def pixiv(tmp_path, monkeypatch):
+    # Pixiv uses ./pixiv-cache when it exists, instead of the user cache.
+    monkeypatch.chdir(tmp_path)
+    tmp_path.joinpath("pixiv-cache").mkdir()
+    px = Pixiv()
+    yield px
+    px._resize_pool.shutdown()
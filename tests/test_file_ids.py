@@ -0,0 +1,13 @@
+from ayayaxyz.file_ids import FileId, FileIdStore
+
+
+def test_put_get_forget(tmp_path):
+    store = FileIdStore(tmp_path.joinpath("file_ids.sqlite"))
+    url = "https://i.pximg.net/img-original/img/2022/01/01/00/00/00/1_p0.png"
+    assert store.get(url) is None
+    store.put(url, "AgACAgQAAxkBAAI")
+    assert isinstance(store.get(url), FileId)
+    assert FileIdStore(tmp_path.joinpath("file_ids.sqlite")).get(url) == "AgACAgQAAxkBAAI"
+    store.forget(url)
+    assert store.get(url) is None
+    assert store.stats()["entries"] == 0
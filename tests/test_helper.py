@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+from ayayaxyz.helper import CallbackRegistry, SendQueue
+
+
+def test_callbacks_expire_and_are_bounded():
+    registry = CallbackRegistry(max_entries=2, ttl=60)
+    for data in ("a", "b", "c"):
+        registry.register(data, data.upper)
+    assert registry.get("a") is None
+    assert registry.get("c") is not None
+    expired = CallbackRegistry(ttl=-1)
+    expired.register("a", print)
+    assert expired.get("a") is None
+    assert expired.stats()["entries"] == 0
+
+
+def test_named_callbacks_get_their_argument():
+    registry = CallbackRegistry()
+
+    async def pages(update, context, arg):
+        return arg
+
+    registry.named("pages", pages)
+    assert asyncio.run(registry.get("@pages:12345")(None, None)) == "12345"
+    assert registry.get("@unknown:1") is None
+
+
+def test_send_queue_merges_edits_and_retries_after_flood_wait():
+    sent = []
+    message = SimpleNamespace(chat_id=1, message_id=2)
+
+    async def edit(text):
+        sent.append(text)
+        return text
+
+    async def flood():
+        if "flood" not in sent:
+            sent.append("flood")
+            raise RetryAfter(0)
+        return "ok"
+
+    async def main():
+        queue = SendQueue(chat_rate=10, chat_burst=1)
+        await queue.send(1, lambda: edit("first"))
+        # The first edit waits for a token, the next ones replace it.
+        results = await asyncio.gather(
+            *(queue.edit(message, lambda text=text: edit(text)) for text in "abc")
+        )
+        return results, await queue.send(2, flood), queue.stats()
+
+    results, flood_result, stats = asyncio.run(main())
+    assert sent == ["first", "c", "flood"]
+    assert results == ["c", "c", "c"]
+    assert flood_result == "ok"
+    assert stats["merged_edits"] == 2
+    assert stats["retries"] == 1
+
+
+def test_send_queue_resends_edits_merged_into_a_cancelled_one():
+    sent = []
+    message = SimpleNamespace(chat_id=1, message_id=2)
+
+    async def edit(text):
+        sent.append(text)
+        return text
+
+    async def main():
+        queue = SendQueue(chat_rate=20, chat_burst=1)
+        await queue.send(1, lambda: edit("first"))
+        owner = asyncio.ensure_future(queue.edit(message, lambda: edit("a")))
+        await asyncio.sleep(0)
+        merged = asyncio.ensure_future(queue.edit(message, lambda: edit("b")))
+        await asyncio.sleep(0)
+        owner.cancel()
+        # Waits for its own turn instead of hanging on the cancelled edit.
+        result = await asyncio.wait_for(merged, timeout=1)
+        return owner, result, queue.stats()
+
+    owner, result, stats = asyncio.run(main())
+    assert owner.cancelled()
+    assert result == "b"
+    assert sent == ["first", "b"]
+    assert stats["pending_edits"] == 0
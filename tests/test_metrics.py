@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from ayayaxyz.metrics import Registry, _Metric, stats_families
+
+
+def test_renders_prometheus_text():
+    registry = Registry()
+    stages = registry.histogram("stage_seconds", "Stage time", ("stage",), buckets=(1,))
+    sent = registry.counter("sent_total", "Messages sent")
+    stats = {"hits": 3, "bytes": 10, "wait_total": 1.5, "tags": {"hits": 1}}
+    registry.add_collector(lambda: stats_families("cache", stats))
+
+    @stages.time(stage="fetch")
+    async def fetch():
+        return "ok"
+
+    assert asyncio.run(fetch()) == "ok"
+    stages.observe(2, stage="fetch")
+    sent.inc(2)
+    lines = registry.render().splitlines()
+    assert "# TYPE stage_seconds histogram" in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="fetch",le="+Inf"} 2' in lines
+    assert 'stage_seconds_count{stage="fetch"} 2' in lines
+    assert "sent_total 2" in lines
+    assert "# TYPE cache_hits_total counter" in lines
+    assert "cache_hits_total 3" in lines
+    assert "# TYPE cache_bytes gauge" in lines
+    assert "cache_bytes 10" in lines
+    assert "cache_wait_total 1.5" in lines
+    assert "cache_tags_hits_total 1" in lines
+
+
+def test_metrics_have_to_collect():
+    with pytest.raises(TypeError):
+        _Metric("untyped", "No samples")
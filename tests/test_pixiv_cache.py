@@ -0,0 +1,70 @@
+from pathlib import Path
+
+from ayayaxyz.api.pixiv.cache import DiskCache, MemoryCache
+
+
+def _write(root, name, size):
+    file = root.joinpath(name)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(b"0" * size)
+    return file
+
+
+def test_evicts_least_recently_served(tmp_path):
+    cache = DiskCache(tmp_path, max_size=250, exclude={"ugoira-cache"})
+    for name in ("a", "b", "c"):
+        _write(tmp_path, f"img/{name}.png", 100)
+        cache.add(f"img/{name}.png")
+    assert cache.lookup("img/a.png")
+    cache.evict()
+    assert not tmp_path.joinpath("img/b.png").exists()
+    assert tmp_path.joinpath("img/a.png").exists()
+    stats = cache.stats()
+    assert stats["bytes"] == 200
+    assert stats["evictions"] == 1
+    assert not cache.lookup("img/b.png")
+    assert cache.stats()["hit_ratio"] == 0.5
+
+
+def test_validator_survives_lookups_and_restarts(tmp_path):
+    _write(tmp_path, "img/a.png", 100)
+    cache = DiskCache(tmp_path)
+    etag = cache.validator("img/a.png")
+    assert etag is not None
+    assert cache.lookup("img/a.png")
+    assert DiskCache(tmp_path).validator("img/a.png") == etag
+    assert cache.validator("img/b.png") is None
+
+
+def test_relative_cache_path_survives_restarts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ("a", "b"):
+        _write(tmp_path, f"pixiv-cache/img/{name}.png", 100)
+    cache = DiskCache(Path("pixiv-cache"), max_size=150)
+    assert cache.lookup("img/b.png")
+    assert cache.validator("img/b.png") is not None
+    cache.evict()
+    assert not tmp_path.joinpath("pixiv-cache/img/a.png").exists()
+    assert cache.stats()["bytes"] == 100
+    assert cache.lookup("img/b.png")
+
+
+def test_ignores_excluded_files(tmp_path):
+    _write(tmp_path, "ugoira-cache/1.zip", 100)
+    _write(tmp_path, "tags.sqlite", 100)
+    _write(tmp_path, "img/a.png", 100)
+    assert DiskCache(tmp_path, exclude={"ugoira-cache"}).stats()["files"] == 1
+
+
+def test_memory_cache_bounds_and_expiry():
+    cache = MemoryCache(max_bytes=20, ttl=60)
+    cache.put(1, "a" * 8)
+    cache.put(2, "b" * 8)
+    assert cache.get(1) == "a" * 8
+    cache.put(3, "c" * 8)
+    assert cache.get(2) is None
+    assert cache.get(3) == "c" * 8
+    expired = MemoryCache(max_bytes=20, ttl=-1)
+    expired.put(1, "a")
+    assert expired.get(1) is None
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,201 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from flask import Flask
+
+from ayayaxyz.api.pixiv.downloader import DOWNLOAD_BYTES
+from ayayaxyz.api.pixiv.exceptions import DownloadError
+
+
+def test_concurrent_downloads_of_an_url_share_one_fetch(pixiv):
+    fetches = []
+
+    async def fetch(url):
+        fetches.append(url)
+        await asyncio.sleep(0.05)
+        return b"image"
+
+    pixiv._fetch_illust = fetch
+
+    async def main():
+        return await asyncio.gather(
+            pixiv._download_illust("https://i.pximg.net/a.png"),
+            pixiv._download_illust("https://i.pximg.net/a.png"),
+        )
+
+    results = asyncio.run(main())
+    assert fetches == ["https://i.pximg.net/a.png"]
+    assert [image.getvalue() for image, _ in results] == [b"image", b"image"]
+    assert not pixiv._inflight
+
+
+def test_download_errors_reach_every_waiter(pixiv):
+    fetches = []
+
+    async def fetch():
+        fetches.append(1)
+        await asyncio.sleep(0.05)
+        raise DownloadError("upstream is down")
+
+    async def main():
+        return await asyncio.gather(
+            pixiv._single_flight(("bytes", "a"), fetch),
+            pixiv._single_flight(("bytes", "a"), fetch),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert len(fetches) == 1
+    assert [str(e) for e in results] == ["upstream is down"] * 2
+    assert not pixiv._inflight
+    # The next download starts over.
+    with pytest.raises(DownloadError):
+        asyncio.run(pixiv._single_flight(("bytes", "a"), fetch))
+    assert len(fetches) == 2
+
+
+class _Upstream:
+    """Stands for a streamed requests response"""
+
+    def __init__(self, chunks, length=None, fail=False):
+        self.status_code = 200
+        self.headers = {"Content-Type": "image/png"}
+        if length is not None:
+            self.headers["Content-Length"] = str(length)
+        self._chunks = chunks
+        self._fail = fail
+
+    def iter_content(self, chunk_size):
+        yield from self._chunks
+        if self._fail:
+            raise ConnectionError("connection reset")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _stream(pixiv, upstream, path):
+    pixiv._pixiv.requests_call = lambda *args, **kwargs: upstream
+    url = "https://i.pximg.net/" + path
+    return asyncio.run(pixiv._stream_illust_to_cache(url, path)), url
+
+
+def test_tee_completes_the_cache_when_the_client_goes_away(pixiv):
+    response, url = _stream(pixiv, _Upstream([b"ab", b"cd", b"ef"], 6), "img/a.png")
+    body = response.response
+    assert next(body) == b"ab"
+    # Client disconnected: WSGI servers close the iterator.
+    body.close()
+    assert pixiv._path.joinpath("img/a.png").read_bytes() == b"abcdef"
+    assert pixiv._cache.lookup("img/a.png")
+    assert not pixiv._path.joinpath("img/a.png.part").exists()
+    assert not pixiv._inflight
+
+
+@pytest.mark.parametrize(
+    "upstream",
+    [_Upstream([b"ab"], fail=True), _Upstream([b"ab", b"cd"], length=10)],
+    ids=["error", "incomplete"],
+)
+def test_tee_drops_the_partial_file_on_failure(pixiv, upstream):
+    counted = DOWNLOAD_BYTES._values.get(("i.pximg.net",), 0)
+    response, url = _stream(pixiv, upstream, "img/b.png")
+    chunks = list(response.response)
+    assert chunks[0] == b"ab"
+    # Bytes of failed downloads are counted too.
+    assert DOWNLOAD_BYTES._values[("i.pximg.net",)] - counted == len(b"".join(chunks))
+    assert not pixiv._path.joinpath("img/b.png").exists()
+    assert not pixiv._path.joinpath("img/b.png.part").exists()
+    assert not pixiv._cache.lookup("img/b.png")
+    assert not pixiv._inflight
+
+
+def test_unread_tee_releases_the_download(pixiv):
+    upstream = _Upstream([b"ab"], 2)
+    response, url = _stream(pixiv, upstream, "img/e.png")
+    # e.g. a HEAD request, Werkzeug closes the response without reading it.
+    response.close()
+    assert not pixiv._inflight
+    assert not pixiv._path.joinpath("img/e.png.part").exists()
+
+
+def test_head_then_get_with_stream_through(pixiv, tmp_path):
+    pixiv._stream_through = True
+    pixiv._pixiv.requests_call = lambda *args, **kwargs: _Upstream([b"ab"], 2)
+
+    async def download(url, f):
+        f.write(b"ab")
+
+    pixiv._downloader.download = download
+    # Like the bot's, one directory below the working directory.
+    root = tmp_path.joinpath("ayayaxyz")
+    root.mkdir()
+    app = Flask(__name__, root_path=str(root))
+    pixiv.flask_api(app)
+    client = app.test_client()
+    url = "https://i.pximg.net/img/f.png"
+    head = client.head("/pixiv/raw", query_string={"url": url})
+    assert head.status_code == 200
+    head.close()
+    assert not pixiv._inflight
+    get = client.get("/pixiv/raw", query_string={"url": url})
+    assert get.status_code == 200
+    assert get.data == b"ab"
+    get.close()
+
+
+def _serve_stream(pixiv, stream, path):
+    """Requests /pixiv/raw from the aiohttp server with `stream` as upstream"""
+
+    async def main():
+        pixiv._stream_through = True
+        pixiv._downloader.stream = stream
+        app = web.Application()
+        pixiv.aiohttp_api(app, route="/pixiv")
+        async with TestClient(TestServer(app)) as client:
+            url = "https://i.pximg.net/" + path
+            params = {"url": url}
+            timeout = aiohttp.ClientTimeout(total=5)
+            async with client.get(
+                "/pixiv/raw", params=params, timeout=timeout
+            ) as response:
+                try:
+                    return response.status, await response.read()
+                except aiohttp.ClientPayloadError:
+                    return response.status, None
+
+    return asyncio.run(main())
+
+
+def test_stream_cut_short_drops_the_connection(pixiv):
+    async def stream(url):
+        async def body():
+            yield b"x" * 500
+
+        return {"Content-Type": "image/png", "Content-Length": "1000"}, body()
+
+    status, body = _serve_stream(pixiv, stream, "img/c.png")
+    # Headers were sent, so the body is cut instead of turning into a 502.
+    assert status == 200
+    assert body is None
+    assert not pixiv._path.joinpath("img/c.png").exists()
+    assert not pixiv._path.joinpath("img/c.png.part").exists()
+    assert not pixiv._inflight
+
+
+def test_stream_failing_before_the_headers_is_a_bad_gateway(pixiv):
+    async def stream(url):
+        raise DownloadError("Failed to download {}".format(url))
+
+    status, body = _serve_stream(pixiv, stream, "img/d.png")
+    assert status == 502
+    assert body.startswith(b"Failed to download")
@@ -0,0 +1,41 @@
+import asyncio
+from threading import Thread
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from ayayaxyz.api.pixiv.downloader import Downloader
+
+
+async def _upstream() -> TestServer:
+    async def image(_: web.Request):
+        return web.Response(body=b"x" * 1000)
+
+    app = web.Application()
+    app.router.add_get("/img.png", image)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def test_runs_on_the_attached_loop_and_bridges_other_loops():
+    async def main():
+        server = await _upstream()
+        url = str(server.make_url("/img.png"))
+        downloader = Downloader()
+        downloader.attach()
+        assert await downloader.get(url) == b"x" * 1000
+        loop = asyncio.get_running_loop()
+        assert downloader._session._loop is loop
+        # e.g. a Flask request, running in its own loop in another thread.
+        results = []
+        thread = Thread(target=lambda: results.append(asyncio.run(downloader.get(url))))
+        thread.start()
+        await asyncio.to_thread(thread.join)
+        assert results == [b"x" * 1000]
+        assert downloader._session._loop is loop
+        assert not downloader._own_loop
+        await downloader.close()
+        await server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from threading import Event
+
+from ayayaxyz.api.pixiv.jobs import JobQueue
+
+
+def _queue(started: list, gate: Event | None = None, **kwargs) -> JobQueue:
+    async def run(key):
+        started.append(key)
+        if gate is not None:
+            await asyncio.to_thread(gate.wait)
+        return key
+
+    return JobQueue(run, **kwargs)
+
+
+def test_jobs_run_in_submission_order():
+    started = []
+    gate = Event()
+    queue = _queue(started, gate, max_workers=1)
+    jobs = [queue.submit(key) for key in ("a", "b", "c")]
+    assert [job.status for job in jobs][1:] == ["queued", "queued"]
+    gate.set()
+    assert [job.future.result(timeout=5) for job in jobs] == ["a", "b", "c"]
+    assert started == ["a", "b", "c"]
+    assert queue.stats()["done"] == 3
+
+
+def test_identical_jobs_are_merged():
+    started = []
+    gate = Event()
+    queue = _queue(started, gate)
+    job = queue.submit("a")
+    assert queue.submit("a") is job
+    gate.set()
+    assert job.future.result(timeout=5) == "a"
+    assert queue.submit("a") is job
+    assert started == ["a"]
+
+
+def test_failed_jobs_can_be_resubmitted():
+    attempts = []
+
+    async def run(key):
+        attempts.append(key)
+        if len(attempts) == 1:
+            raise RuntimeError("Convert error")
+        return key
+
+    queue = JobQueue(run)
+    job = queue.submit("a")
+    assert job.future.exception(timeout=5) is not None
+    assert job.status == "failed" and job.error == "Convert error"
+    retry = queue.submit("a")
+    assert retry is not job
+    assert retry.future.result(timeout=5) == "a"
+
+
+def test_wait_times_out_without_touching_the_job(caplog):
+    gate = Event()
+    queue = _queue([], gate)
+    job = queue.submit("a")
+    # Each Flask request waits in its own short-lived loop.
+    assert asyncio.run(JobQueue.wait(job, timeout=0.05)) is None
+    assert job.status == "running"
+    with caplog.at_level(logging.ERROR):
+        gate.set()
+        assert job.future.result(timeout=5) == "a"
+    assert not caplog.records
+    assert asyncio.run(JobQueue.wait(job, timeout=0.05)) == "a"
+
+
+def test_jobs_whose_file_is_gone_run_again(tmp_path):
+    video = tmp_path.joinpath("1.webm")
+
+    async def run(key):
+        video.write_bytes(b"video")
+        return video
+
+    queue = JobQueue(run)
+    job = queue.submit(1)
+    assert job.future.result(timeout=5) == video
+    assert queue.submit(1) is job
+    # Evicted from the cache.
+    video.unlink()
+    rerun = queue.submit(1)
+    assert rerun is not job
+    assert rerun.future.result(timeout=5) == video
@@ -0,0 +1,29 @@
+import pytest
+
+from ayayaxyz.api.pixiv.exceptions import SearchError
+from ayayaxyz.api.pixiv.matcher import TagMatcher
+
+
+def _illust(*tags: tuple[str, str | None]) -> dict:
+    return {"tags": [{"name": name, "translated_name": tl} for name, tl in tags]}
+
+
+def test_matches_words_and_conjoined_words():
+    matcher = TagMatcher(["Genshin Impact", "Hu Tao"])
+    assert matcher.matches(_illust(("原神", "Genshin Impact"), ("胡桃", "Hu Tao")))
+    assert matcher.matches(_illust(("原神", "Genshin Impact"), ("taohu", None)))
+    assert not matcher.matches(_illust(("原神", "Genshin Impact")))
+
+
+def test_r18_and_exclude_tags():
+    matcher = TagMatcher(["genshin"], exclude_tags=["-Keqing"])
+    assert not matcher.matches(_illust(("genshin", None), ("R-18", None)))
+    assert not matcher.matches(_illust(("genshin", None), ("刻晴", "Keqing")))
+    assert TagMatcher(["genshin", "R-18"]).matches(
+        _illust(("genshin", None), ("R-18", None))
+    )
+
+
+def test_select_raises_without_match():
+    with pytest.raises(SearchError):
+        TagMatcher(["eula"]).select([_illust(("genshin", None))] * 3)
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from ayayaxyz.api.pixiv.cache import MemoryCache
+
+NEXT_URL = "https://app-api.pixiv.net/v1/search/illust?word=cat&sort=date_desc&offset="
+# offset: (illust IDs, next page)
+PAGES = {0: ([1, 2], NEXT_URL + "2"), 2: ([3], None)}
+
+
+def _illust(illust_id: int) -> dict:
+    return {"id": illust_id, "tags": [{"name": "cat", "translated_name": None}]}
+
+
+def _search_api(pixiv) -> list[int]:
+    offsets = []
+
+    def search_illust(word, offset=0, **kwargs):
+        offsets.append(int(offset))
+        ids, next_url = PAGES[int(offset)]
+        return {"illusts": [_illust(i) for i in ids], "next_url": next_url}
+
+    pixiv._pixiv.search_illust = search_illust
+    return offsets
+
+
+def _next(pixiv, count: int) -> list[int]:
+    async def main():
+        return [
+            (await pixiv.search_illust(["cat"], related=False, pool=True))["id"]
+            for _ in range(count)
+        ]
+
+    return asyncio.run(main())
+
+
+def test_pool_is_served_then_refilled_from_the_next_page(pixiv):
+    offsets = _search_api(pixiv)
+    served = _next(pixiv, 3)
+    assert sorted(served) == [1, 2, 3]
+    assert offsets == [0, 2]
+    # Exhausted, starts over from the first page.
+    assert _next(pixiv, 1)[0] in (1, 2)
+    assert offsets == [0, 2, 0]
+
+
+def test_pool_expires(pixiv):
+    pixiv._search_pools = MemoryCache(max_bytes=256, ttl=0.05, sizeof=lambda _: 1)
+    offsets = _search_api(pixiv)
+    _next(pixiv, 1)
+    _next(pixiv, 1)
+    assert offsets == [0]
+    time.sleep(0.1)
+    _next(pixiv, 1)
+    assert offsets == [0, 0]
+
+
+def test_unused_results_are_served_again(pixiv):
+    offsets = _search_api(pixiv)
+    first = _next(pixiv, 1)[0]
+    pixiv.return_search_result(["cat"], {"id": first}, related=False)
+    assert _next(pixiv, 1) == [first]
+    assert offsets == [0]
@@ -0,0 +1,22 @@
+from ayayaxyz.api.pixiv.ratelimit import RateLimiter, TokenBucket
+
+
+def test_bucket_spaces_requests_after_burst():
+    bucket = TokenBucket("test", rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+    assert 0.15 < bucket.reserve() <= 0.2
+
+
+def test_throttling_backs_off_and_recovers():
+    limiter = RateLimiter(app_rate=10)
+    limiter.report(limiter.app, 429, "2")
+    stats = limiter.app.stats()
+    assert stats["rate"] == 5
+    assert stats["throttled"] == 1
+    assert 1.9 < limiter.app.reserve() <= 2.2
+    for _ in range(100):
+        limiter.report(limiter.app, 200)
+    assert limiter.app.stats()["rate"] == 10
+    assert limiter.for_host("i.pximg.net") is limiter.image
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from ayayaxyz.api.pixiv.exceptions import SearchRelatedError
+from ayayaxyz.api.pixiv.matcher import TagMatcher
+
+
+def _illust(illust_id: int, tag: str = "cat") -> dict:
+    return {"id": illust_id, "tags": [{"name": tag, "translated_name": None}]}
+
+
+def _related(pixiv, graph: dict[int, list[dict]]) -> list[int]:
+    fetched = []
+
+    async def fetch(illust_id):
+        fetched.append(illust_id)
+        return graph.get(illust_id, [])
+
+    pixiv._fetch_related = fetch
+    return fetched
+
+
+def _search(pixiv, recurse=1, beam=2):
+    return asyncio.run(
+        pixiv._related_illust_beam(1, TagMatcher({"cat"}), recurse=recurse, beam=beam)
+    )
+
+
+def test_beam_expands_at_most_beam_illusts_per_hop(pixiv):
+    fetched = _related(
+        pixiv,
+        {
+            1: [_illust(2), _illust(3), _illust(4), _illust(5, "dog")],
+            2: [_illust(6)],
+            3: [_illust(6)],
+            4: [_illust(6)],
+        },
+    )
+    assert _search(pixiv)["id"] == 6
+    assert fetched[0] == 1
+    # Matching candidates are shuffled, any two of them are expanded.
+    assert len(fetched[1:]) == 2
+    assert set(fetched[1:]) < {2, 3, 4}
+
+
+def test_beam_never_returns_a_visited_illust(pixiv):
+    fetched = _related(
+        pixiv,
+        {
+            1: [_illust(2), _illust(2), _illust(3)],
+            # Only links back to illusts seen already, but for 4.
+            2: [_illust(1), _illust(3)],
+            3: [_illust(2), _illust(4)],
+        },
+    )
+    assert _search(pixiv)["id"] == 4
+    assert fetched.count(2) == 1
+
+
+def test_beam_fails_when_a_hop_has_no_candidate(pixiv):
+    _related(pixiv, {1: [_illust(2)], 2: [_illust(1), _illust(3, "dog")]})
+    with pytest.raises(SearchRelatedError):
+        _search(pixiv)
+    _related(pixiv, {1: [_illust(5, "dog")]})
+    with pytest.raises(SearchRelatedError):
+        _search(pixiv, recurse=0)
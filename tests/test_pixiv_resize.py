@@ -0,0 +1,48 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import ayayaxyz.api.pixiv as pixiv_module
+from ayayaxyz.api.pixiv.resize import fit_photo, fits
+
+
+def _png(size: tuple[int, int], mode: str = "RGB") -> bytes:
+    output = BytesIO()
+    Image.new(mode, size).save(output, "PNG")
+    return output.getvalue()
+
+
+def test_fit_photo_downscales_to_limits():
+    data = _png((8000, 4000), "RGBA")
+    assert not fits(data)
+    fitted = fit_photo(data)
+    assert fits(fitted)
+    with Image.open(BytesIO(fitted)) as image:
+        assert image.format == "JPEG"
+        assert sum(image.size) <= 10000
+        assert abs(image.width / image.height - 2) < 0.01
+    assert fits(_png((1200, 800)))
+
+
+@pytest.mark.parametrize("stage", ["header", "downscale"])
+def test_decompression_bombs_are_sent_as_is(pixiv, monkeypatch, stage):
+    data = _png((200, 200))
+    url = "https://i.pximg.net/img/a.png"
+
+    async def download(url):
+        return BytesIO(data), "a.png"
+
+    # Errors over twice the limit.
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    if stage == "downscale":
+        # e.g. an original over 10 MB, whose header isn't read.
+        monkeypatch.setattr(pixiv_module, "fits", lambda data: False)
+        pixiv._resize_pool.shutdown()
+        pixiv._resize_pool = ThreadPoolExecutor(1)
+    monkeypatch.setattr(pixiv, "_download_illust", download)
+    image, name = asyncio.run(pixiv._download_fitted_illust(url))
+    assert (image.getvalue(), name) == (data, "a.png")
+    assert not pixiv._path.joinpath("img/a_fit.jpg").exists()
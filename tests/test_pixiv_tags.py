@@ -0,0 +1,56 @@
+import asyncio
+
+from ayayaxyz.api.pixiv.exceptions import SearchError
+from ayayaxyz.api.pixiv.tags import TagStore
+
+
+def test_translations_round_trip_and_survive_restarts(tmp_path):
+    store = TagStore(tmp_path.joinpath("tags.sqlite"))
+    assert store.get("Blue Archive") == (False, None)
+    store.put("Blue Archive", "ブルーアーカイブ", "cps")
+    store.learn(
+        [{"tags": [{"name": "原神", "translated_name": "Genshin Impact"}]}]
+    )
+    store = TagStore(tmp_path.joinpath("tags.sqlite"))
+    assert store.get("blue archive") == (True, "ブルーアーカイブ")
+    assert store.get("genshin impact", fallback=False) == (True, "原神")
+    assert store.stats() == {"translations": 2, "failures": 0}
+
+
+def test_failures_expire_and_dont_hide_the_fallback(tmp_path):
+    store = TagStore(tmp_path.joinpath("tags.sqlite"), negative_ttl=60)
+    store.put("nothing", None, "cps")
+    # Only the Ajax API failed, the search fallback may still find it.
+    assert store.get("nothing", fallback=False) == (True, None)
+    assert store.get("nothing") == (False, None)
+    store.put("nothing", None, "legacy")
+    assert store.get("nothing") == (True, None)
+    # Translations learned from illusts replace failures.
+    store.learn([{"tags": [{"name": "何か", "translated_name": "Nothing"}]}])
+    assert store.get("nothing") == (True, "何か")
+    store.put("gone", None, "legacy")
+    expired = TagStore(tmp_path.joinpath("tags.sqlite"), negative_ttl=-1)
+    assert expired.get("gone") == (False, None)
+
+
+def test_tags_without_any_illust_are_remembered(pixiv):
+    lookups = []
+    searches = []
+
+    async def translate_tag(tag_kw, kw):
+        lookups.append(kw)
+        return "良い" if "good" in tag_kw else None
+
+    async def search_illust(tags, **kwargs):
+        searches.append(tags)
+        raise SearchError("No images matches specified tags")
+
+    pixiv._translate_tag = translate_tag
+    pixiv._search_illust = search_illust
+    assert asyncio.run(pixiv.translate_tags(["good", "bad"])) == ["良い", "bad"]
+    assert searches == [["bad"]]
+    assert pixiv._tags.stats() == {"translations": 1, "failures": 1}
+    lookups.clear()
+    assert asyncio.run(pixiv.translate_tags(["good", "bad"])) == ["良い", "bad"]
+    assert lookups == []
+    assert searches == [["bad"]]
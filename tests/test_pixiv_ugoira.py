@@ -0,0 +1,158 @@
+import asyncio
+import re
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+
+from ayayaxyz.api.pixiv import ugoira
+from ayayaxyz.api.pixiv.ugoira import PROFILES, output_args, setpts_filter
+
+
+def _timestamps(expression: str, frame_count: int) -> list[int]:
+    """Evaluates the setpts expression of each piped frame, in milliseconds"""
+    terms = re.findall(r"eq\(N,(\d+)\)\*(\d+)", expression)
+    return [
+        sum(int(ts) for n, ts in terms if int(n) == index)
+        for index in range(frame_count)
+    ]
+
+
+def test_frames_are_timed_by_their_own_delay():
+    frames = [{"delay": 100}, {"delay": 50}, {"delay": 250}]
+    expression = setpts_filter(frames)
+    assert expression.startswith("setpts='round((")
+    assert expression.endswith(")/1000/TB)'")
+    # The last frame is piped twice, the repeat ends the last delay.
+    assert _timestamps(expression, 4) == [0, 100, 150, 400]
+
+
+@pytest.mark.parametrize("name", list(PROFILES))
+def test_profile_filter_follows_the_timing_filter(name):
+    profile = PROFILES[name]
+    out = Path("out.{}".format(profile.extension))
+    args = output_args(profile, out, ["setpts=PTS"])
+    vf = ["setpts=PTS"] + ([profile.filter] if profile.filter else [])
+    assert args[:2] == ["-vf", ",".join(vf)]
+    assert args[2 : 2 + len(profile.args)] == profile.args
+    assert args[-5:] == ["-vsync", "vfr", "-f", profile.format, str(out)]
+
+
+def test_profiles_without_filters_skip_vf():
+    assert "-vf" not in output_args(PROFILES["webm"], Path("out.webm"), [])
+    assert "-vf" not in output_args(PROFILES["apng"], Path("out.png"), [])
+    assert output_args(PROFILES["gif"], Path("out.gif"), [])[:2] == [
+        "-vf",
+        PROFILES["gif"].filter,
+    ]
+
+
+def test_profile_extensions():
+    assert {name: profile.extension for name, profile in PROFILES.items()} == {
+        "webm": "webm",
+        "webm-best": "webm",
+        "mp4": "mp4",
+        "gif": "gif",
+        "apng": "png",
+    }
+
+
+class _Process:
+    """Stands for ffmpeg, writes what it was piped to the output file"""
+
+    def __init__(self, args):
+        self.args = args
+        self.piped = []
+        self.stdin = self
+
+    def write(self, data):
+        self.piped.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        Path(self.args[-1]).write_bytes(b"".join(self.piped))
+
+    async def wait(self):
+        return 0
+
+
+def test_encode_zip_pipes_frames_in_order(tmp_path, monkeypatch):
+    processes = []
+
+    async def create_subprocess_exec(*args, **kwargs):
+        processes.append(_Process(args))
+        return processes[-1]
+
+    monkeypatch.setattr(
+        ugoira.asyncio, "create_subprocess_exec", create_subprocess_exec
+    )
+    archive = tmp_path.joinpath("ugoira.zip")
+    with ZipFile(archive, "w") as f:
+        f.writestr("000000.jpg", b"a")
+        f.writestr("000001.jpg", b"b")
+    frames = [
+        {"file": "000000.jpg", "delay": 60},
+        {"file": "000001.jpg", "delay": 40},
+    ]
+    out = tmp_path.joinpath("ugoira.mp4")
+    asyncio.run(ugoira.encode_zip(archive, frames, out, PROFILES["mp4"]))
+    args = list(processes[0].args)
+    assert args[:8] == [
+        "ffmpeg", "-y", "-f", "image2pipe", "-framerate", "1000", "-i", "pipe:0"
+    ]
+    assert args[9].startswith(setpts_filter(frames) + ",scale=")
+    assert out.read_bytes() == b"abb"
+    assert not tmp_path.joinpath("ugoira.mp4.part").exists()
+
+
+def test_extracted_conversion_leaves_no_frames_behind(pixiv, monkeypatch):
+    pixiv._ugoira_pipe = False
+    frames = [{"file": "000000.jpg", "delay": 100}]
+    src = "https://i.pximg.net/1_ugoira.zip"
+    meta = {"body": {"originalSrc": src, "frames": frames}}
+    seen = []
+
+    async def download(url, f):
+        with ZipFile(f, "w") as archive:
+            archive.writestr("000000.jpg", b"a")
+
+    class Process:
+        def __init__(self, args):
+            self.args = args
+
+        async def wait(self):
+            concat = Path(self.args[self.args.index("-i") + 1])
+            seen.append(concat.with_name("000000.jpg").read_bytes())
+            Path(self.args[-1]).write_bytes(b"video")
+            return 0
+
+    async def create_subprocess_exec(*args, **kwargs):
+        return Process(args)
+
+    monkeypatch.setattr(pixiv._downloader, "download", download)
+    monkeypatch.setattr(
+        ugoira.asyncio, "create_subprocess_exec", create_subprocess_exec
+    )
+    video = asyncio.run(pixiv.get_video_from_ugoira(1, meta, profile="mp4"))
+    assert seen == [b"a"]
+    assert video.read_bytes() == b"video"
+    assert sorted(p.name for p in pixiv._ugoira_cache.iterdir()) == ["meta"]
+
+
+def test_videos_are_evicted_with_the_images(pixiv, monkeypatch):
+    async def convert(url, frames, out, profile):
+        out.write_bytes(b"0" * 100)
+        return out
+
+    pixiv._cache._max_size = 150
+    monkeypatch.setattr(pixiv, "_convert_ugoira_pipe", convert)
+    frames = [{"file": "000000.jpg", "delay": 100}]
+    videos = []
+    for illust_id in (1, 2):
+        meta = {"body": {"originalSrc": "{}.zip".format(illust_id), "frames": frames}}
+        videos.append(asyncio.run(pixiv.get_video_from_ugoira(illust_id, meta)))
+    pixiv._cache.evict()
+    assert [video.exists() for video in videos] == [False, True]
+    assert pixiv._cache.stats()["bytes"] == 100
@@ -0,0 +1,62 @@
+import asyncio
+
+from ayayaxyz.prefetch import Prefetcher
+
+
+def test_claimed_prefetches_are_not_discarded():
+    discarded = []
+
+    async def main():
+        prefetcher = Prefetcher(ttl=0.1, delay=0)
+        assert prefetcher.schedule(
+            "a", lambda: asyncio.sleep(0, "a"), lambda: discarded.append("a")
+        )
+        assert not prefetcher.schedule("a", lambda: asyncio.sleep(0, "b"))
+        result = await prefetcher.take("a")
+        await asyncio.sleep(0.2)
+        return result, await prefetcher.take("a")
+
+    assert asyncio.run(main()) == ("a", None)
+    assert discarded == []
+
+
+def test_unclaimed_and_failed_prefetches_are_discarded():
+    discarded = []
+
+    async def fail():
+        raise ValueError("no result")
+
+    async def main():
+        prefetcher = Prefetcher(ttl=0.1, delay=0)
+        prefetcher.schedule(
+            "stale", lambda: asyncio.sleep(0), lambda: discarded.append("stale")
+        )
+        prefetcher.schedule("failed", fail, lambda: discarded.append("failed"))
+        assert await prefetcher.take("failed") is None
+        await asyncio.sleep(0.2)
+        return await prefetcher.take("stale")
+
+    assert asyncio.run(main()) is None
+    assert discarded == ["failed", "stale"]
+
+
+def test_prefetches_are_bounded_in_bytes():
+    discarded = []
+
+    async def main():
+        prefetcher = Prefetcher(max_bytes=10, sizeof=len, delay=0)
+        prefetcher.schedule("a", lambda: asyncio.sleep(0, "a" * 8))
+        await asyncio.sleep(0.01)
+        # Too big for what's left of the budget, thrown away once fetched.
+        prefetcher.schedule(
+            "b", lambda: asyncio.sleep(0, "b" * 8), lambda: discarded.append("b")
+        )
+        await asyncio.sleep(0.01)
+        assert await prefetcher.take("b") is None
+        assert await prefetcher.take("a") == "a" * 8
+        # Claiming a result gives its bytes back.
+        assert prefetcher.schedule("c", lambda: asyncio.sleep(0, "c" * 8))
+        return await prefetcher.take("c")
+
+    assert asyncio.run(main()) == "c" * 8
+    assert discarded == ["b"]
@@ -0,0 +1,33 @@
+import asyncio
+from types import SimpleNamespace
+
+from ayayaxyz.scheduler import ChatScheduler
+
+
+def _update(chat_id: int):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+def test_orders_per_chat_and_runs_chats_concurrently():
+    events = []
+
+    async def handler(update, context):
+        events.append(("start", update.effective_chat.id, context))
+        await asyncio.sleep(0.05)
+        events.append(("end", update.effective_chat.id, context))
+
+    async def main():
+        scheduler = ChatScheduler(max_workers=2)
+        handle = scheduler.wrap(handler)
+        await asyncio.gather(
+            handle(_update(1), "a"), handle(_update(1), "b"), handle(_update(2), "c")
+        )
+        return scheduler.stats()
+
+    stats = asyncio.run(main())
+    # Chat 2 doesn't wait for chat 1, chat 1 updates don't overlap.
+    assert events[:2] == [("start", 1, "a"), ("start", 2, "c")]
+    assert events.index(("end", 1, "a")) < events.index(("start", 1, "b"))
+    assert stats["processed"] == 3
+    assert stats["queued"] == stats["running"] == stats["chats"] == 0
+    assert stats["wait_max"] > 0